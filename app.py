@@ -2,24 +2,153 @@ import os
 import uuid
 import secrets
 import datetime
-from flask import Flask, render_template, request, redirect, url_for, session, g, flash
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+import mimetypes
+import json
+import hashlib
+import random
+import signal
+import threading
+import time
+import click
+import logging
+import csv
+import io
+import itertools
+import math
+import atexit
+from flask import Flask, render_template, request, redirect, url_for, session, g, flash, abort, send_file, Response, stream_with_context, has_request_context, before_render_template, template_rendered
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, event, exc
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import joinedload
-from functools import wraps
+from sqlalchemy.dialects import postgresql, sqlite
+from functools import wraps, lru_cache
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from markupsafe import Markup, escape
+from collections import namedtuple, Counter
+from catalog_cache import Catalog, CatalogCache, CourseRecord, SessionRecord, QuizRecord
+from ttl_cache import TTLCache
+from media_store import MediaStore
+from image_pipeline import DerivativePool, DERIVATIVE_WIDTHS, derivative_path, derivative_stem, is_derivative, is_image, make_derivatives, remove_derivatives
+from metrics import MetricsRegistry, RequestStats
+from transcode import HLS_MIMETYPES, MASTER_NAME, TranscodeError, ffmpeg_available, hls_dir, hls_ready, hls_stem, is_hls_output, remove_hls, transcode_hls
+from write_behind import WriteBehindBuffer
+from course_package import MEDIA_PREFIX, PackageError, is_member, media_refs, open_package, stream_package
 
 # --- APP CONFIGURATION ---
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY', 'a_default_secret_key_for_local_development')
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///database.db')
+# Hosted Postgres often hands out postgres:// URLs, which SQLAlchemy no longer accepts.
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///database.db').replace('postgres://', 'postgresql://', 1)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
 UPLOAD_FOLDER = os.path.join('static', 'uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'mp4', 'webm'}
+VIDEO_EXTENSIONS = {'mp4', 'webm'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['MEDIA_CHUNK_SIZE'] = int(os.environ.get('MEDIA_CHUNK_SIZE', 1024 * 1024))
+# Video delivery: '' streams from Python, 'nginx' hands off via X-Accel-Redirect to MEDIA_ACCEL_PREFIX
+# (an `internal` location aliased to static/uploads), 'sendfile' uses X-Sendfile (Apache/lighttpd).
+app.config['MEDIA_ACCEL'] = os.environ.get('MEDIA_ACCEL', '').lower()
+app.config['MEDIA_ACCEL_PREFIX'] = os.environ.get('MEDIA_ACCEL_PREFIX', '/protected-media/')
+app.config['USE_X_SENDFILE'] = app.config['MEDIA_ACCEL'] == 'sendfile'
+app.config['MEDIA_MAX_AGE'] = int(os.environ.get('MEDIA_MAX_AGE', 24 * 3600))
+app.config['THUMBNAIL_WORKERS'] = int(os.environ.get('THUMBNAIL_WORKERS', 2))
+# HLS transcoding: ffmpeg processes one `flask worker` runs at once, the longest a single video may take, and the
+# segment length (also the key frame interval, so renditions can switch at every segment).
+app.config['TRANSCODE_WORKERS'] = int(os.environ.get('TRANSCODE_WORKERS', 1))
+app.config['TRANSCODE_TIMEOUT'] = int(os.environ.get('TRANSCODE_TIMEOUT', 2 * 3600))
+app.config['HLS_SEGMENT_SECONDS'] = int(os.environ.get('HLS_SEGMENT_SECONDS', 6))
+app.config['JOB_RETRY_BASE'] = float(os.environ.get('JOB_RETRY_BASE', 10))
+app.config['JOB_LOCK_TIMEOUT'] = int(os.environ.get('JOB_LOCK_TIMEOUT', 15 * 60))
+app.config['CATALOG_CHECK_INTERVAL'] = float(os.environ.get('CATALOG_CHECK_INTERVAL', 2))
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 10000))
+app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', 60))
+# Course access grants cached for the heartbeat and HLS segment routes. A revocation clears the entry in the worker
+# that handled it; other workers keep theirs for up to ACCESS_CACHE_TTL seconds (0 disables the cache).
+app.config['ACCESS_CACHE_SIZE'] = int(os.environ.get('ACCESS_CACHE_SIZE', 20000))
+app.config['ACCESS_CACHE_TTL'] = float(os.environ.get('ACCESS_CACHE_TTL', 60))
+app.config['ADMIN_ACCESS_PAGE_SIZE'] = int(os.environ.get('ADMIN_ACCESS_PAGE_SIZE', 50))
+app.config['BULK_ENROLL_CHUNK'] = int(os.environ.get('BULK_ENROLL_CHUNK', 500))
+app.config['EXPORT_BATCH_SIZE'] = int(os.environ.get('EXPORT_BATCH_SIZE', 2000))
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 2048))
+app.config['FRAGMENT_CACHE_TTL'] = float(os.environ.get('FRAGMENT_CACHE_TTL', 300))
+# Throttles as '<attempts>/<seconds>': a burst of that many, refilled evenly over the period. Empty or 0 disables.
+app.config['LOGIN_RATE_PER_IP'] = os.environ.get('LOGIN_RATE_PER_IP', '30/300')
+app.config['LOGIN_RATE_PER_EMAIL'] = os.environ.get('LOGIN_RATE_PER_EMAIL', '10/300')
+app.config['REGISTER_RATE_PER_IP'] = os.environ.get('REGISTER_RATE_PER_IP', '10/3600')
+# Any werkzeug method string, e.g. 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'. Hashes made with other
+# parameters are upgraded the next time their owner logs in.
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+# Reverse proxies in front of the app that append to X-Forwarded-For (1 behind nginx). 0 trusts no header, so a
+# direct client cannot spoof its address; behind a proxy it must be set, or every client shares the proxy's IP.
+app.config['PROXY_FIX_X_FOR'] = int(os.environ.get('PROXY_FIX_X_FOR', 0))
+if app.config['PROXY_FIX_X_FOR']: app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+# Watch heartbeats: how often the player reports, how often buffered positions are written, and how much of a
+# video must be watched before it counts as completed.
+app.config['WATCH_HEARTBEAT_INTERVAL'] = int(os.environ.get('WATCH_HEARTBEAT_INTERVAL', 15))
+app.config['WATCH_FLUSH_INTERVAL'] = float(os.environ.get('WATCH_FLUSH_INTERVAL', 10))
+app.config['WATCH_COMPLETE_RATIO'] = float(os.environ.get('WATCH_COMPLETE_RATIO', 0.9))
+# Most (user, video) positions a worker holds unwritten; further new ones are refused while the database is behind.
+app.config['WATCH_BUFFER_MAX_KEYS'] = int(os.environ.get('WATCH_BUFFER_MAX_KEYS', 100000))
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 200))
+# Each worker writes its counters here; /admin/metrics sums every file, so it must be shared by all workers.
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR', os.path.join(app.instance_path, 'metrics'))
+app.config['METRICS_FLUSH_INTERVAL'] = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+
+# --- DATABASE ENGINE PROFILE ---
+# SQLite: WAL lets readers run alongside the single writer and busy_timeout makes writers wait instead of failing
+# with "database is locked". Postgres: a bounded, pre-pinged pool and a per-statement timeout.
+SQLITE_PRAGMAS = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'wal'),
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),  # ms
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'normal'),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),  # bytes
+    'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -64000)),  # negative: KiB
+}
+
+def engine_options(uri):
+    if make_url(uri).get_backend_name() != 'postgresql': return {}
+    options = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') != '0',
+    }
+    statement_timeout = int(os.environ.get('DB_STATEMENT_TIMEOUT', 30000))  # ms, 0 disables
+    if statement_timeout: options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout}'}
+    return options
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 
 db = SQLAlchemy(app)
 
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items(): cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+def configure_engine():
+    """Hooks the SQLite pragmas onto every new connection and logs the active engine profile."""
+    url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() == 'sqlite':
+        with app.app_context(): event.listen(db.engine, 'connect', _apply_sqlite_pragmas)
+        profile = dict(SQLITE_PRAGMAS)
+    else:
+        profile = {k: v for k, v in app.config['SQLALCHEMY_ENGINE_OPTIONS'].items() if k != 'connect_args'}
+        profile['statement_timeout'] = os.environ.get('DB_STATEMENT_TIMEOUT', 30000)
+    app.logger.info('Database %s: %s', url.render_as_string(hide_password=True), ', '.join(f'{k}={v}' for k, v in profile.items()))
+
+configure_engine()
+
+def dialect_insert(model):
+    """An INSERT for the active database that supports ON CONFLICT (SQLite and Postgres)."""
+    return (postgresql if db.engine.dialect.name == 'postgresql' else sqlite).insert(model)
+
 # --- DATABASE MODELS (SQLAlchemy ORM) ---
 class User(db.Model):
     __tablename__ = 'users'
@@ -29,6 +158,8 @@ class User(db.Model):
     password = db.Column(db.String(200), nullable=False)
     account_code = db.Column(db.String(50), unique=True, nullable=False)
     is_admin = db.Column(db.Boolean, default=False, nullable=False)
+    # Stamped into the signed session at login; bumping it logs out every existing session.
+    auth_version = db.Column(db.Integer, default=1, server_default='1', nullable=False)
     courses = db.relationship('StudentCourseAccess', back_populates='user', cascade="all, delete-orphan")
 
 class Course(db.Model):
@@ -42,26 +173,44 @@ class Course(db.Model):
     student_count = db.Column(db.Integer)
     sessions = db.relationship('Session', backref='course', lazy=True, cascade="all, delete-orphan")
     students = db.relationship('StudentCourseAccess', back_populates='course', cascade="all, delete-orphan")
+    progress = db.relationship('UserCourseProgress', lazy=True, cascade="all, delete-orphan")
 
 class Session(db.Model):
     __tablename__ = 'sessions'
     id = db.Column(db.Integer, primary_key=True)
-    course_id = db.Column(db.Integer, db.ForeignKey('courses.id'), nullable=False)
+    course_id = db.Column(db.Integer, db.ForeignKey('courses.id'), nullable=False, index=True)
     title = db.Column(db.String(150), nullable=False)
     thumbnail_url = db.Column(db.String(200))
     is_free = db.Column(db.Boolean, default=False, nullable=False)
-    video1_url = db.Column(db.String(300))
-    video2_url = db.Column(db.String(300))
-    video3_url = db.Column(db.String(300))
-    video4_url = db.Column(db.String(300))
+    # Number of rows in session_videos, kept in sync by set_session_videos.
+    video_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    videos = db.relationship('SessionVideo', order_by='SessionVideo.position', lazy=True, cascade="all, delete-orphan")
     quizzes = db.relationship('Quiz', backref='session', lazy=True, cascade="all, delete-orphan")
     completions = db.relationship('VideoCompletion', backref='session', lazy=True, cascade="all, delete-orphan")
     quiz_attempts = db.relationship('StudentQuizAttempt', backref='session', lazy=True, cascade="all, delete-orphan")
+    quiz_history = db.relationship('QuizAttemptHistory', lazy=True, cascade="all, delete-orphan")
+    progress = db.relationship('UserSessionProgress', lazy=True, cascade="all, delete-orphan")
+    watch_positions = db.relationship('VideoPosition', lazy=True, cascade="all, delete-orphan")
+
+    @property
+    def video_urls(self):
+        return [video.url for video in self.videos]
+
+# Ordered videos of a session; `position` is the 1-based video_index used by completions and routes.
+class SessionVideo(db.Model):
+    __tablename__ = 'session_videos'
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), nullable=False)
+    position = db.Column(db.Integer, nullable=False)
+    url = db.Column(db.String(300), nullable=False)
+    # NULL for external videos (or without ffmpeg), else 'queued', 'ready' or 'failed'; see VIDEO TRANSCODING.
+    hls_status = db.Column(db.String(20))
+    __table_args__ = (db.UniqueConstraint('session_id', 'position', name='uq_session_videos_session_position'),)
 
 class Quiz(db.Model):
     __tablename__ = 'quizzes'
     id = db.Column(db.Integer, primary_key=True)
-    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), nullable=False)
+    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), nullable=False, index=True)
     question = db.Column(db.Text, nullable=False)
     option1 = db.Column(db.String(200), nullable=False)
     option2 = db.Column(db.String(200), nullable=False)
@@ -76,6 +225,8 @@ class StudentCourseAccess(db.Model):
     course_id = db.Column(db.Integer, db.ForeignKey('courses.id'), nullable=False)
     user = db.relationship('User', back_populates='courses')
     course = db.relationship('Course', back_populates='students')
+    __table_args__ = (db.UniqueConstraint('user_id', 'course_id', name='uq_student_course_access_user_course'),
+                      db.Index('ix_student_course_access_course_id', 'course_id'))
 
 class VideoCompletion(db.Model):
     __tablename__ = 'video_completions'
@@ -83,7 +234,22 @@ class VideoCompletion(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), nullable=False)
     video_index = db.Column(db.Integer, nullable=False)
+    completed_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    __table_args__ = (db.UniqueConstraint('user_id', 'session_id', 'video_index', name='uq_video_completions_user_session_video'),
+                      db.Index('ix_video_completions_session_id', 'session_id'))
 
+# Last reported playback position per user and video, written in batches from the watch buffer.
+class VideoPosition(db.Model):
+    __tablename__ = 'video_positions'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), primary_key=True)
+    video_index = db.Column(db.Integer, primary_key=True)
+    position = db.Column(db.Float, nullable=False)  # seconds
+    duration = db.Column(db.Float)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    __table_args__ = (db.Index('ix_video_positions_session_id', 'session_id'),)
+
+# One summary row per user and session: the latest attempt plus the best score so far.
 class StudentQuizAttempt(db.Model):
     __tablename__ = 'student_quiz_attempts'
     id = db.Column(db.Integer, primary_key=True)
@@ -92,20 +258,173 @@ class StudentQuizAttempt(db.Model):
     score = db.Column(db.Integer, nullable=False)
     total_questions = db.Column(db.Integer, nullable=False)
     attempted_on = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    best_score = db.Column(db.Integer)
+    attempt_count = db.Column(db.Integer, default=1, server_default='1', nullable=False)
+    __table_args__ = (db.UniqueConstraint('user_id', 'session_id', name='uq_student_quiz_attempts_user_session'),
+                      db.Index('ix_student_quiz_attempts_session_id', 'session_id'))
+
+# Append-only: every graded submission, with the options chosen.
+class QuizAttemptHistory(db.Model):
+    __tablename__ = 'quiz_attempt_history'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), nullable=False)
+    score = db.Column(db.Integer, nullable=False)
+    total_questions = db.Column(db.Integer, nullable=False)
+    answers = db.Column(db.Text, nullable=False)
+    attempted_on = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    __table_args__ = (db.Index('ix_quiz_attempt_history_user_session', 'user_id', 'session_id'),
+                      db.Index('ix_quiz_attempt_history_session_id', 'session_id'))
+
+# Rollups of video_completions, maintained incrementally by mark_video_complete.
+# `flask rebuild-progress` recomputes them from video_completions.
+class UserSessionProgress(db.Model):
+    __tablename__ = 'user_session_progress'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), primary_key=True)
+    course_id = db.Column(db.Integer, db.ForeignKey('courses.id'), nullable=False)
+    completed_videos = db.Column(db.Integer, default=0, nullable=False)
+    __table_args__ = (db.Index('ix_user_session_progress_user_course', 'user_id', 'course_id'),
+                      db.Index('ix_user_session_progress_session_id', 'session_id'))
+
+class UserCourseProgress(db.Model):
+    __tablename__ = 'user_course_progress'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    course_id = db.Column(db.Integer, db.ForeignKey('courses.id'), primary_key=True)
+    completed_videos = db.Column(db.Integer, default=0, nullable=False)
+
+# Single row (id=1) bumped by every admin write to courses, sessions or quizzes.
+class CatalogVersion(db.Model):
+    __tablename__ = 'catalog_version'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, default=1, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+
+# One row per file in the content-addressed media store; the file is deleted when ref_count reaches 0.
+class MediaObject(db.Model):
+    __tablename__ = 'media_objects'
+    id = db.Column(db.Integer, primary_key=True)
+    url = db.Column(db.String(300), unique=True, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+
+# Durable background jobs, run by `flask worker`.
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    idempotency_key = db.Column(db.String(200), unique=True)
+    last_error = db.Column(db.Text)
+    locked_by = db.Column(db.String(100))
+    locked_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    __table_args__ = (db.Index('ix_jobs_status_run_at', 'status', 'run_at'),)
 
 class PasswordResetToken(db.Model):
     __tablename__ = 'password_reset_tokens'
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     token = db.Column(db.String(100), unique=True, nullable=False)
-    expires_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+# Token buckets for login/register throttling, shared by every worker. updated_at is epoch seconds so the
+# refill can be computed inside the UPDATE on any database.
+class RateLimitBucket(db.Model):
+    __tablename__ = 'rate_limit_buckets'
+    key = db.Column(db.String(200), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    capacity = db.Column(db.Float, nullable=False)
+    refill_rate = db.Column(db.Float, nullable=False)  # tokens per second
+    updated_at = db.Column(db.Float, nullable=False, index=True)
+
+# --- METRICS ---
+# Every request gets a RequestStats in g; engine and template events add to it and after_request files it under
+# the endpoint. Slow statements are logged with their parameters whether or not they run inside a request.
+metrics = MetricsRegistry(app.config['METRICS_DIR'], 'skillify', app.config['METRICS_FLUSH_INTERVAL'])
+
+def current_request_stats():
+    return g.get('request_stats') if has_request_context() else None
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    slow = elapsed * 1000 >= app.config['SLOW_QUERY_MS']
+    if slow: app.logger.warning('Slow query (%.0f ms): %s | parameters: %.500r', elapsed * 1000, ' '.join(statement.split()), parameters)
+    stats = current_request_stats()
+    if stats is not None:
+        stats.queries += 1; stats.db_time += elapsed; stats.slow_queries += slow
+
+def _drop_failed_query(exception_context):
+    started = exception_context.connection.info.get('query_started') if exception_context.connection is not None else None
+    if started: started.pop()
+
+with app.app_context():
+    event.listen(db.engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(db.engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(db.engine, 'handle_error', _drop_failed_query)
+
+@before_render_template.connect_via(app)
+def _template_started(sender, template, context, **extra):
+    g.setdefault('render_started', []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def _template_finished(sender, template, context, **extra):
+    stats = current_request_stats(); started = g.get('render_started')
+    if stats is not None and started: stats.render_time += time.perf_counter() - started.pop()
+
+@app.after_request
+def record_request_metrics(response):
+    stats = current_request_stats()
+    if stats is not None: metrics.record(request.endpoint or 'unmatched', request.method, response.status_code, stats)
+    return response
+
+atexit.register(metrics.retire)
+
+# --- AUTHENTICATED USER CACHE ---
+UserRecord = namedtuple('UserRecord', 'id name is_admin account_code auth_version')
+user_cache = TTLCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+
+def user_record_stmt(user_id):
+    return db.select(User.id, User.name, User.is_admin, User.account_code, User.auth_version).where(User.id == user_id)
+
+def load_user(user_id, auth_version=None):
+    """Returns the slim record for a logged-in user, or None if the user is gone or the session is stale."""
+    record = user_cache.get((user_id, auth_version)) if auth_version is not None else None
+    if record is None:
+        row = db.session.execute(user_record_stmt(user_id)).first()
+        if row is None or (auth_version is not None and row.auth_version != auth_version): return None
+        record = UserRecord(*row)
+        user_cache.set((record.id, record.auth_version), record)
+    return record
+
+def invalidate_user_sessions(user):
+    """Bumps the user's auth version so cached records and existing sessions stop matching."""
+    user_cache.pop((user.id, user.auth_version))
+    user.auth_version = (user.auth_version or 1) + 1
 
 # --- HOOKS & DECORATORS ---
 @app.before_request
 def before_request():
-    g.user = None
+    g.request_stats = RequestStats(); g.user = None
+    if request.endpoint == 'static':
+        # Session videos are only served through session_video, which checks course access.
+        filename = (request.view_args or {}).get('filename', '')
+        if filename.startswith('uploads/') and filename.rsplit('.', 1)[-1].lower() in VIDEO_EXTENSIONS | HLS_MIMETYPES.keys(): abort(404)
+        return
     if 'user_id' in session:
-        g.user = db.session.get(User, session['user_id'])
+        g.user = load_user(session['user_id'], session.get('auth_version'))
+        if g.user is None: session.clear()
+        elif 'auth_version' not in session: session['auth_version'] = g.user.auth_version
 
 @app.context_processor
 def inject_current_year():
@@ -132,36 +451,1194 @@ def admin_required(f):
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# --- SETUP COMMAND ---
+def has_course_access(user_id, course_id):
+    return db.session.execute(course_access_stmt(user_id, course_id)).first() is not None
+
+access_cache = TTLCache(app.config['ACCESS_CACHE_SIZE'], app.config['ACCESS_CACHE_TTL'])
+
+def has_course_access_cached(user_id, course_id):
+    """has_course_access for high-frequency endpoints; only grants are cached, for up to a minute."""
+    if access_cache.get((user_id, course_id)): return True
+    granted = has_course_access(user_id, course_id)
+    if granted: access_cache.set((user_id, course_id), True)
+    return granted
+
+def forget_course_access(pairs):
+    """Drops cached grants for revoked (user_id, course_id) pairs; call once the revocation is committed."""
+    for user_id, course_id in pairs: access_cache.pop((int(user_id), int(course_id)))
+
+# --- CATALOG CACHE ---
+def read_catalog_version():
+    return db.session.execute(db.select(CatalogVersion.version).where(CatalogVersion.id == 1)).scalar() or 0
+
+def load_catalog(version):
+    courses = [CourseRecord(c.id, c.title, c.description, c.thumbnail_url, c.status, c.duration_weeks, c.student_count)
+               for c in Course.query.all()]
+    titles = {c.id: c.title for c in courses}
+    videos = {}; hls = {}
+    for session_id, url, hls_status in db.session.execute(db.select(SessionVideo.session_id, SessionVideo.url, SessionVideo.hls_status)
+                                                          .order_by(SessionVideo.session_id, SessionVideo.position)):
+        videos.setdefault(session_id, []).append(url); hls.setdefault(session_id, []).append(hls_status == 'ready')
+    sessions = [SessionRecord(s.id, s.course_id, titles.get(s.course_id), s.title, s.thumbnail_url, bool(s.is_free),
+                              tuple(videos.get(s.id, ())), s.video_count, tuple(hls.get(s.id, ())))
+                for s in Session.query.all()]
+    quizzes = [QuizRecord(q.id, q.session_id, q.question, q.option1, q.option2, q.option3, q.option4, q.correct_answer)
+               for q in Quiz.query.all()]
+    updated_at = db.session.execute(db.select(CatalogVersion.updated_at).where(CatalogVersion.id == 1)).scalar()
+    return Catalog(version, courses, sessions, quizzes, updated_at)
+
+catalog_cache = CatalogCache(load_catalog, read_catalog_version, app.config['CATALOG_CHECK_INTERVAL'])
+
+def get_catalog():
+    return catalog_cache.get()
+
+def bump_catalog_version():
+    """Marks the catalog as changed; other workers reload it once this transaction commits."""
+    now = datetime.datetime.utcnow()
+    updated = CatalogVersion.query.filter_by(id=1).update(
+        {CatalogVersion.version: CatalogVersion.version + 1, CatalogVersion.updated_at: now}, synchronize_session=False)
+    if not updated: db.session.add(CatalogVersion(id=1, version=1, updated_at=now))
+    db.session.info['catalog_changed'] = True
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_catalog_after_commit(db_session):
+    if db_session.info.pop('catalog_changed', False): catalog_cache.invalidate()
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_catalog_change(db_session):
+    db_session.info.pop('catalog_changed', None)
+
+# --- MEDIA STORE ---
+media_store = MediaStore(os.path.join(app.root_path, app.config['UPLOAD_FOLDER']), 'uploads', app.config['MEDIA_CHUNK_SIZE'])
+
+def media_columns():
+    """Every column that can reference a file in static/uploads."""
+    return (Course.thumbnail_url, Session.thumbnail_url, SessionVideo.url)
+
+def media_reference_count(url):
+    return sum(db.session.execute(db.select(*[db.select(func.count()).where(col == url).scalar_subquery()
+                                              for col in media_columns()])).one())
+
+def retain_media(url, sha256, size, count=1):
+    """Takes `count` references in one upsert, which also waits for a remove_media job that holds the row."""
+    stmt = dialect_insert(MediaObject).values(url=url, sha256=sha256, size=size, ref_count=count, created_at=datetime.datetime.utcnow())
+    db.session.execute(stmt.on_conflict_do_update(index_elements=['url'],
+                                                  set_={'ref_count': MediaObject.ref_count + stmt.excluded.ref_count}))
+
+def store_upload(file):
+    """Streams an uploaded file into the media store and takes a reference to it; returns its static path."""
+    staged = media_store.stage(file.stream, file.filename.rsplit('.', 1)[1])
+    retain_media(staged.url, staged.sha256, staged.size)
+    media_store.publish(staged)  # only now: if a removal job got to an identical file first, this puts it back
+    return staged.url
+
+def store_image_upload(file):
+    """Like store_upload, and queues the resized derivatives so the request doesn't wait on them."""
+    url = store_upload(file)
+    derivative_pool.submit(media_store.path_for(url))
+    return url
+
+def release_media(url):
+    """Drops one reference to an uploaded file. Call after the referencing row has been changed or deleted;
+    once nothing references it, a background job deletes the file."""
+    if not media_store.owns(url): return
+    db.session.flush()
+    if MediaObject.query.filter_by(url=url).update({MediaObject.ref_count: MediaObject.ref_count - 1}, synchronize_session=False):
+        if db.session.execute(db.select(MediaObject.ref_count).where(MediaObject.url == url)).scalar() > 0: return
+        MediaObject.query.filter_by(url=url).delete(synchronize_session=False)
+    elif media_reference_count(url):
+        return  # a legacy upload that is still shared with another row
+    enqueue_job('remove_media', {'url': url})
+
+# --- BACKGROUND JOBS ---
+JOB_HANDLERS = {}
+LONG_RUNNING_JOBS = set()
+
+def job_handler(kind, long_running=False):
+    """Registers a job handler. A long-running job keeps refreshing its lock while it runs, so a worker starting
+    up meanwhile does not take it for one left behind by a dead worker."""
+    def register(f):
+        JOB_HANDLERS[kind] = f
+        if long_running: LONG_RUNNING_JOBS.add(kind)
+        return f
+    return register
+
+@contextmanager
+def job_lock_heartbeat(job_id, worker_id):
+    """Bumps the job's locked_at every third of JOB_LOCK_TIMEOUT for as long as the block runs."""
+    stop = threading.Event()
+
+    def beat():
+        with app.app_context():
+            while not stop.wait(app.config['JOB_LOCK_TIMEOUT'] / 3):
+                try:
+                    Job.query.filter_by(id=job_id, locked_by=worker_id).update({Job.locked_at: datetime.datetime.utcnow()},
+                                                                              synchronize_session=False)
+                    db.session.commit()
+                except exc.SQLAlchemyError as e:
+                    db.session.rollback(); app.logger.warning('Could not refresh the lock of job %s: %s', job_id, e)
+
+    thread = threading.Thread(target=beat, name=f'job-lock-{job_id}', daemon=True); thread.start()
+    try:
+        yield
+    finally:
+        stop.set(); thread.join()
+
+def enqueue_job(kind, payload, key=None, delay=0, max_attempts=5):
+    """Adds a job in the current transaction; a job with the same idempotency key is only enqueued once."""
+    stmt = dialect_insert(Job).values(kind=kind, payload=json.dumps(payload), idempotency_key=key, max_attempts=max_attempts,
+                                      run_at=datetime.datetime.utcnow() + datetime.timedelta(seconds=delay))
+    db.session.execute(stmt.on_conflict_do_nothing(index_elements=['idempotency_key']))
+
+def claim_job(worker_id):
+    """Atomically moves the next due job to 'running' for this worker and returns it, or None."""
+    now = datetime.datetime.utcnow()
+    job_id = db.session.execute(db.select(Job.id).where(Job.status == 'queued', Job.run_at <= now)
+                                .order_by(Job.run_at, Job.id).limit(1).with_for_update(skip_locked=True)).scalar()
+    if job_id is None:
+        db.session.rollback(); return None
+    claimed = Job.query.filter_by(id=job_id, status='queued').update(
+        {Job.status: 'running', Job.locked_by: worker_id, Job.locked_at: now, Job.attempts: Job.attempts + 1}, synchronize_session=False)
+    db.session.commit()
+    return db.session.get(Job, job_id) if claimed else None
+
+def run_job(job):
+    """Runs one claimed job; failures are retried with exponential backoff until max_attempts."""
+    job_id = job.id
+    try:
+        handler = JOB_HANDLERS.get(job.kind)
+        if handler is None: raise LookupError(f'No handler for job kind {job.kind!r}')
+        if job.kind in LONG_RUNNING_JOBS:
+            with job_lock_heartbeat(job_id, job.locked_by): handler(json.loads(job.payload))
+        else:
+            handler(json.loads(job.payload))
+        job.status = 'done'; job.finished_at = datetime.datetime.utcnow(); job.last_error = None
+    except Exception as e:
+        db.session.rollback(); job = db.session.get(Job, job_id)
+        app.logger.warning('Job %s (%s) failed on attempt %s: %s', job.id, job.kind, job.attempts, e)
+        job.last_error = f'{type(e).__name__}: {e}'[:2000]
+        if job.attempts >= job.max_attempts:
+            job.status = 'failed'; job.finished_at = datetime.datetime.utcnow()
+        else:
+            delay = min(3600, app.config['JOB_RETRY_BASE'] * 2 ** (job.attempts - 1)) * random.uniform(0.8, 1.2)
+            job.status = 'queued'; job.run_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+    job.locked_by = None; job.locked_at = None
+    db.session.commit()
+
+def requeue_stale_jobs():
+    """Returns jobs left 'running' by a worker that died to the queue."""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=app.config['JOB_LOCK_TIMEOUT'])
+    count = Job.query.filter(Job.status == 'running', Job.locked_at < cutoff).update(
+        {Job.status: 'queued', Job.locked_by: None, Job.locked_at: None}, synchronize_session=False)
+    db.session.commit()
+    return count
+
+def job_queue_depth():
+    """Returns {(kind, status): count} over every job still in the table."""
+    rows = db.session.execute(db.select(Job.kind, Job.status, func.count()).group_by(Job.kind, Job.status)).all()
+    return {(kind, status): count for kind, status, count in rows}
+
+@job_handler('remove_media')
+def remove_media_job(payload):
+    url = payload['url']
+    # Hold the url's media_objects row (a placeholder if it is gone) until the job commits. An upload of the same
+    # bytes then either retained it first, or waits and finds the file missing when it publishes its own copy.
+    stmt = dialect_insert(MediaObject).values(url=url, sha256='', size=0, ref_count=0)
+    refs = db.session.execute(stmt.on_conflict_do_update(index_elements=['url'], set_={'ref_count': MediaObject.ref_count})
+                              .returning(MediaObject.ref_count)).scalar()
+    if refs > 0 or media_reference_count(url):
+        db.session.rollback(); return  # re-uploaded or shared again: keep the file and its derivatives
+    media_store.remove(url)
+    if is_image(url): remove_derivatives(media_store.path_for(url))
+    if is_video(url): remove_hls(media_store.path_for(url))
+    db.session.execute(db.delete(MediaObject).where(MediaObject.url == url))
+
+@job_handler('send_password_reset')
+def send_password_reset_job(payload):
+    print(f"--- PASSWORD RESET LINK (SIMULATED EMAIL) to {payload['email']}: {payload['reset_url']} ---")
+
+# --- IMAGE DERIVATIVES ---
+def _derivatives_written(path, written):
+    """New derivatives change what image_srcset emits, so pages and fragments cached without them must go."""
+    if not written: return
+    try:
+        with app.app_context(): bump_catalog_version(); db.session.commit()
+    except Exception as e:
+        app.logger.warning('Could not bump the catalog version after derivatives of %s: %s', path, e)
+
+derivative_pool = DerivativePool(app.config['THUMBNAIL_WORKERS'],
+                                 on_error=lambda path, e: app.logger.warning('Thumbnail derivatives failed for %s: %s', path, e),
+                                 on_done=_derivatives_written)
+srcset_cache = TTLCache(4096, 60)  # keyed by catalog version too, so "no derivatives yet" ends with the next bump
+
+@app.template_global()
+def image_srcset(url, sizes='100vw'):
+    """Emits srcset/sizes attributes for an upload's resized derivatives, or nothing until they exist."""
+    if not media_store.owns(url) or not is_image(url): return ''
+    key = (get_catalog().version, url); srcset = srcset_cache.get(key)
+    if srcset is None:
+        path = media_store.path_for(url); srcset = ''
+        for fmt in ('webp', 'jpeg'):
+            widths = [w for w in DERIVATIVE_WIDTHS if os.path.exists(derivative_path(path, w, fmt))]
+            if widths:
+                srcset = ', '.join(f"{url_for('static', filename=derivative_path(url, w, fmt))} {w}w" for w in widths); break
+        srcset_cache.set(key, srcset)
+    return Markup(f' srcset="{escape(srcset)}" sizes="{escape(sizes)}"') if srcset else ''
+
+# --- VIDEO TRANSCODING ---
+# Uploaded videos get an adaptive-bitrate HLS ladder next to the original, made by `flask worker` through the
+# job queue (at most TRANSCODE_WORKERS ffmpeg processes per worker) or in bulk by `flask transcode-backlog`.
+# session_detail switches a video to HLS once its hls_status is 'ready'; until then the original is served.
+transcode_slots = threading.BoundedSemaphore(app.config['TRANSCODE_WORKERS'])
+
+def is_video(url):
+    return url.rsplit('.', 1)[-1].lower() in VIDEO_EXTENSIONS
+
+def queue_transcode(url):
+    """The hls_status for a session video pointing at `url`, enqueueing its transcode when one is needed."""
+    if not media_store.owns(url) or not is_video(url): return None
+    path = media_store.path_for(url)
+    if not os.path.isfile(path): return None
+    if hls_ready(path): return 'ready'
+    if not ffmpeg_available(): return None
+    enqueue_job('transcode_video', {'url': url}, max_attempts=3)
+    return 'queued'
+
+def set_hls_status(url, status):
+    """Sets the status of every session video using `url`, in the current transaction."""
+    updated = db.session.execute(db.update(SessionVideo).where(SessionVideo.url == url, SessionVideo.hls_status.is_distinct_from(status))
+                                 .values(hls_status=status)).rowcount
+    if updated: bump_catalog_version()
+
+@job_handler('transcode_video', long_running=True)
+def transcode_video_job(payload):
+    url = payload['url']; path = media_store.path_for(url)
+    if not os.path.isfile(path): return  # removed since the job was queued
+    try:
+        with transcode_slots:
+            transcode_hls(path, segment_seconds=app.config['HLS_SEGMENT_SECONDS'], timeout=app.config['TRANSCODE_TIMEOUT'])
+    except TranscodeError as e:
+        app.logger.warning('Transcoding %s failed: %s', url, e); set_hls_status(url, 'failed'); return
+    set_hls_status(url, 'ready')
+
+# --- PAGE CACHING ---
+# Rendered HTML only changes with the catalog and with what the viewer can see, so catalog pages carry an ETag
+# built from exactly those inputs and their repeated blocks are cached per worker under the same kind of key.
+# RENDER_VERSION changes whenever templates or app code are redeployed.
+RENDER_VERSION = max(os.stat(path).st_mtime_ns for path in
+                     [__file__, *(entry.path for entry in os.scandir(os.path.join(app.root_path, 'templates')))])
+fragment_cache = TTLCache(app.config['FRAGMENT_CACHE_SIZE'], app.config['FRAGMENT_CACHE_TTL'])
+
+@app.template_global()
+def cached_fragment(key, caller):
+    """`{% call cached_fragment(key) %}...{% endcall %}` renders the block once per key and worker."""
+    html = fragment_cache.get(key)
+    if html is None:
+        html = caller(); fragment_cache.set(key, html)
+    return html
+
+def render_conditional(template, etag_parts, last_modified=None, **context):
+    """Renders a page with validators, answering 304 without rendering when the client's copy is current.
+
+    `etag_parts` must cover everything the page depends on besides the template. Pages with pending flash
+    messages are rendered normally and get no validators.
+    """
+    if session.get('_flashes'): return render_template(template, **context)
+    response = Response(mimetype='text/html')
+    response.set_etag(hashlib.sha1(repr((template, RENDER_VERSION, datetime.date.today().year, *etag_parts)).encode()).hexdigest())
+    if last_modified: response.last_modified = last_modified.replace(tzinfo=datetime.timezone.utc)
+    response.cache_control.private = True; response.cache_control.no_cache = True
+    etag = response.get_etag()[0]
+    if request.if_none_match: fresh = request.if_none_match.contains(etag)
+    else: fresh = bool(last_modified and request.if_modified_since and response.last_modified <= request.if_modified_since)
+    if fresh:
+        response.status_code = 304; return response
+    response.set_data(render_template(template, **context))
+    return response
+
+# --- PROGRESS ---
+def set_session_videos(sess, urls):
+    """Replaces a session's ordered video list and its stored video_count."""
+    current = {video.position: video for video in sess.videos}
+    for position, url in enumerate(urls, start=1):
+        video = current.pop(position, None)
+        if video is None: sess.videos.append(SessionVideo(position=position, url=url, hls_status=queue_transcode(url)))
+        elif video.url != url: video.url = url; video.hls_status = queue_transcode(url)
+    for video in current.values(): sess.videos.remove(video)
+    sess.video_count = len(urls)
+
+def bump_progress(user_id, session_id, course_id, delta=1):
+    """Applies a completion delta to the session and course rollups in the current transaction.
+
+    Each rollup is a single upsert, so concurrent first completions for the same user add up instead of colliding.
+    """
+    for model, row in ((UserSessionProgress, {'user_id': user_id, 'session_id': session_id, 'course_id': course_id}),
+                       (UserCourseProgress, {'user_id': user_id, 'course_id': course_id})):
+        stmt = dialect_insert(model).values(**row, completed_videos=delta)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=[col.name for col in model.__table__.primary_key],
+            set_={'completed_videos': model.completed_videos + stmt.excluded.completed_videos}))
+
+def drop_session_progress(session_id, course_id):
+    """Subtracts a session's completions from its course rollups; its own rollup rows go when the session is deleted."""
+    done = db.select(UserSessionProgress.completed_videos).where(
+        UserSessionProgress.session_id == session_id, UserSessionProgress.user_id == UserCourseProgress.user_id).scalar_subquery()
+    learners = db.select(UserSessionProgress.user_id).where(UserSessionProgress.session_id == session_id)
+    db.session.execute(db.update(UserCourseProgress)
+                       .where(UserCourseProgress.course_id == course_id, UserCourseProgress.user_id.in_(learners))
+                       .values(completed_videos=UserCourseProgress.completed_videos - done))
+
+def session_progress_stmt(user_id, course_id):
+    return db.select(UserSessionProgress.session_id, UserSessionProgress.completed_videos) \
+        .where(UserSessionProgress.user_id == user_id, UserSessionProgress.course_id == course_id)
+
+def session_progress_for_course(user_id, course_id):
+    return dict(db.session.execute(session_progress_stmt(user_id, course_id)).all())
+
+def course_progress_stmt(user_id, course_ids):
+    return db.select(UserCourseProgress.course_id, UserCourseProgress.completed_videos) \
+        .where(UserCourseProgress.user_id == user_id, UserCourseProgress.course_id.in_(course_ids))
+
+def progress_percentages(totals, completed, course_ids):
+    """{course_id: percent} from {course_id: videos} and {course_id: completed videos}."""
+    return {cid: min(100.0, completed.get(cid, 0) / totals[cid] * 100) if totals.get(cid) else 0 for cid in course_ids}
+
+def rebuild_progress(course_id=None):
+    """Recomputes the progress rollups from video_completions, optionally for a single course."""
+    session_q = UserSessionProgress.query; course_q = UserCourseProgress.query
+    if course_id is not None:
+        session_q = session_q.filter_by(course_id=course_id); course_q = course_q.filter_by(course_id=course_id)
+    session_q.delete(synchronize_session=False); course_q.delete(synchronize_session=False)
+
+    completed = func.count(db.distinct(VideoCompletion.video_index))
+    per_session = db.select(VideoCompletion.user_id, VideoCompletion.session_id, Session.course_id, completed) \
+        .join(Session, Session.id == VideoCompletion.session_id) \
+        .group_by(VideoCompletion.user_id, VideoCompletion.session_id, Session.course_id)
+    if course_id is not None: per_session = per_session.where(Session.course_id == course_id)
+    db.session.execute(db.insert(UserSessionProgress).from_select(
+        ['user_id', 'session_id', 'course_id', 'completed_videos'], per_session))
+
+    per_course = db.select(UserSessionProgress.user_id, UserSessionProgress.course_id, func.sum(UserSessionProgress.completed_videos)) \
+        .group_by(UserSessionProgress.user_id, UserSessionProgress.course_id)
+    if course_id is not None: per_course = per_course.where(UserSessionProgress.course_id == course_id)
+    db.session.execute(db.insert(UserCourseProgress).from_select(['user_id', 'course_id', 'completed_videos'], per_course))
+
+# --- WATCH HEARTBEATS ---
+# The player reports its position every few seconds. Reports are coalesced per (user, session, video) in this
+# worker and written in one batch per WATCH_FLUSH_INTERVAL: an upsert into video_positions, plus completions
+# (and their progress rollups) for videos watched past WATCH_COMPLETE_RATIO.
+Heartbeat = namedtuple('Heartbeat', 'position duration completed')
+
+def merge_heartbeats(old, new):
+    return Heartbeat(new.position, max(old.duration or 0, new.duration or 0) or None, old.completed or new.completed)
+
+def flush_watch_positions(batch):
+    """Writes a batch of {(user_id, session_id, video_index): Heartbeat} in one transaction."""
+    with app.app_context():
+        now = datetime.datetime.utcnow()
+        positions = [{'user_id': u, 'session_id': s, 'video_index': v, 'position': beat.position, 'duration': beat.duration,
+                      'updated_at': now} for (u, s, v), beat in batch.items()]
+        stmt = dialect_insert(VideoPosition)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['user_id', 'session_id', 'video_index'],
+            set_={'position': stmt.excluded.position, 'duration': stmt.excluded.duration, 'updated_at': stmt.excluded.updated_at}), positions)
+        completions = [{'user_id': u, 'session_id': s, 'video_index': v, 'completed_at': now} for (u, s, v), beat in batch.items() if beat.completed]
+        if completions:
+            stmt = dialect_insert(VideoCompletion).on_conflict_do_nothing(index_elements=['user_id', 'session_id', 'video_index'])
+            inserted = db.session.execute(stmt.returning(VideoCompletion.user_id, VideoCompletion.session_id), completions).all()
+            catalog = get_catalog()
+            for (user_id, session_id), delta in Counter(map(tuple, inserted)).items():
+                sess = catalog.session(session_id)
+                if sess: bump_progress(user_id, session_id, sess.course_id, delta)
+        db.session.commit()
+
+watch_buffer = WriteBehindBuffer(flush_watch_positions, merge_heartbeats, app.config['WATCH_FLUSH_INTERVAL'],
+                                 max_keys=app.config['WATCH_BUFFER_MAX_KEYS'],
+                                 on_error=lambda e: app.logger.warning('Watch position flush failed, will retry: %s', e),
+                                 on_drop=lambda key, e: app.logger.warning('Dropped watch position %s: %s', key, e))
+atexit.register(watch_buffer.close)
+
+def resume_position(user_id, session_id, video_index, stored):
+    """Where the player should pick up: the newest buffered report, else the stored one."""
+    beat = watch_buffer.peek((user_id, session_id, video_index))
+    return beat.position if beat else stored or 0
+
+# --- QUIZ GRADING ---
+def greatest(a, b):
+    return func.max(a, b) if db.engine.dialect.name == 'sqlite' else func.greatest(a, b)
+
+def least(a, b):
+    return func.min(a, b) if db.engine.dialect.name == 'sqlite' else func.least(a, b)
+
+def grade_quiz(answer_key, form):
+    """Grades submitted answers against a session's cached answer key in one pass: (score, answers)."""
+    score = 0; answers = {}
+    for quiz_id, correct in answer_key:
+        chosen = form.get(f'quiz_{quiz_id}', '')
+        answers[quiz_id] = int(chosen) if chosen.isdigit() else None
+        score += answers[quiz_id] == correct
+    return score, answers
+
+def record_quiz_attempt(user_id, session_id, score, total, answers):
+    """Appends the attempt to the history and upserts the summary row; two writes, no reads."""
+    now = datetime.datetime.utcnow()
+    db.session.execute(db.insert(QuizAttemptHistory).values(
+        user_id=user_id, session_id=session_id, score=score, total_questions=total, answers=json.dumps(answers), attempted_on=now))
+    stmt = dialect_insert(StudentQuizAttempt).values(user_id=user_id, session_id=session_id, score=score, total_questions=total,
+                                                     attempted_on=now, best_score=score, attempt_count=1)
+    db.session.execute(stmt.on_conflict_do_update(index_elements=['user_id', 'session_id'], set_={
+        'score': stmt.excluded.score, 'total_questions': stmt.excluded.total_questions, 'attempted_on': stmt.excluded.attempted_on,
+        'best_score': greatest(func.coalesce(StudentQuizAttempt.best_score, 0), stmt.excluded.score),
+        'attempt_count': StudentQuizAttempt.attempt_count + 1}))
+
+# --- LOGIN THROTTLING ---
+# Login and register are throttled before any password hashing, so a credential-stuffing burst is turned away
+# cheaply instead of tying up every worker on KDF work. Buckets live in the database and are updated with one
+# upsert per attempt, so all workers share them. A rejected attempt still costs a token (down to -1), so a
+# client that keeps hammering stays locked out until it backs off.
+def parse_rate(value):
+    """'<attempts>/<seconds>' -> (capacity, tokens per second), or None when the limit is disabled."""
+    attempts, _, seconds = str(value or '0').partition('/')
+    if float(attempts) <= 0: return None
+    return float(attempts), float(attempts) / float(seconds or 60)
+
+def client_ip():
+    # The real client behind PROXY_FIX_X_FOR proxies; ProxyFix has already rewritten remote_addr.
+    return request.remote_addr or 'unknown'
+
+def take_tokens(limits):
+    """Spends one token from each (key, rate) bucket; returns the seconds to wait, 0 if the attempt may go ahead."""
+    rows = []; now = time.time()
+    for key, rate in limits:
+        parsed = parse_rate(rate)
+        if parsed: rows.append({'key': key[:200], 'tokens': parsed[0] - 1, 'capacity': parsed[0], 'refill_rate': parsed[1], 'updated_at': now})
+    if not rows: return 0
+    stmt = dialect_insert(RateLimitBucket).values(rows)
+    refilled = least(stmt.excluded.capacity, RateLimitBucket.tokens + (now - RateLimitBucket.updated_at) * stmt.excluded.refill_rate)
+    stmt = stmt.on_conflict_do_update(index_elements=['key'], set_={
+        'tokens': greatest(refilled - 1, -1), 'capacity': stmt.excluded.capacity,
+        'refill_rate': stmt.excluded.refill_rate, 'updated_at': now,
+    }).returning(RateLimitBucket.tokens, RateLimitBucket.refill_rate)
+    buckets = db.session.execute(stmt).all(); db.session.commit()
+    return max([(1 - tokens) / refill_rate for tokens, refill_rate in buckets if tokens < 0], default=0)
+
+def throttle(action, email, template):
+    """A 429 response for `template` when this IP or email has used up its attempts for `action`, else None."""
+    ip_rate = app.config['LOGIN_RATE_PER_IP' if action == 'login' else 'REGISTER_RATE_PER_IP']
+    wait = math.ceil(take_tokens([(f'{action}:ip:{client_ip()}', ip_rate),
+                                  (f'{action}:email:{(email or "").strip().lower()}', app.config['LOGIN_RATE_PER_EMAIL'])]))
+    if not wait: return None
+    flash(f'Too many attempts. Please try again in {wait} seconds.', 'error')
+    return render_template(template), 429, {'Retry-After': str(wait)}
+
+def hash_password(password):
+    return generate_password_hash(password, method=app.config['PASSWORD_HASH_METHOD'])
+
+@lru_cache(maxsize=None)
+def _hash_prefix(method):
+    return generate_password_hash('', method=method).split('$', 1)[0]  # werkzeug spells out default parameters
+
+def password_needs_rehash(stored):
+    """True when a stored hash was made with a different method or cost than PASSWORD_HASH_METHOD."""
+    return stored.split('$', 1)[0] != _hash_prefix(app.config['PASSWORD_HASH_METHOD'])
+
+# --- STUDENT SEARCH ---
+# SQLite: an external-content FTS5 table with the trigram tokenizer, kept in sync with `users` by triggers, so
+# every write path (register, password resets, scripts) updates it. Postgres: pg_trgm GIN indexes that ILIKE uses.
+USER_SEARCH_COLUMNS = ('name', 'email', 'account_code')
+users_search = db.table('users_search', db.column('rowid'))
+_user_search_ready = None
+
+def create_search_index():
+    """Creates the trigram index behind the admin student search; returns True if it had to be built."""
+    global _user_search_ready
+    conn = db.session.connection(); cols = ', '.join(USER_SEARCH_COLUMNS)
+    if conn.dialect.name == 'postgresql':
+        conn.exec_driver_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for col in USER_SEARCH_COLUMNS:
+            conn.exec_driver_sql(f'CREATE INDEX IF NOT EXISTS ix_users_{col}_trgm ON users USING gin ({col} gin_trgm_ops)')
+        db.session.commit(); return False
+    if conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'users_search'").first():
+        _user_search_ready = True; return False
+    try:
+        conn.exec_driver_sql(f"CREATE VIRTUAL TABLE users_search USING fts5({cols}, content='users', content_rowid='id', tokenize='trigram')")
+    except exc.OperationalError as e:
+        db.session.rollback(); print(f'Student search index unavailable ({e}); admin search will scan users.'); return False
+    new_cols = ', '.join(f'new.{col}' for col in USER_SEARCH_COLUMNS); old_cols = ', '.join(f'old.{col}' for col in USER_SEARCH_COLUMNS)
+    conn.exec_driver_sql(f'CREATE TRIGGER users_search_ai AFTER INSERT ON users BEGIN '
+                         f'INSERT INTO users_search(rowid, {cols}) VALUES (new.id, {new_cols}); END')
+    conn.exec_driver_sql(f'CREATE TRIGGER users_search_ad AFTER DELETE ON users BEGIN '
+                         f"INSERT INTO users_search(users_search, rowid, {cols}) VALUES ('delete', old.id, {old_cols}); END")
+    conn.exec_driver_sql(f'CREATE TRIGGER users_search_au AFTER UPDATE OF {cols} ON users BEGIN '
+                         f"INSERT INTO users_search(users_search, rowid, {cols}) VALUES ('delete', old.id, {old_cols}); "
+                         f'INSERT INTO users_search(rowid, {cols}) VALUES (new.id, {new_cols}); END')
+    conn.exec_driver_sql("INSERT INTO users_search(users_search) VALUES ('rebuild')")
+    db.session.commit(); _user_search_ready = True
+    print('Created student search index.'); return True
+
+def user_search_ready():
+    global _user_search_ready
+    if _user_search_ready is None:
+        _user_search_ready = bool(db.session.execute(db.text("SELECT 1 FROM sqlite_master WHERE name = 'users_search'")).first())
+    return _user_search_ready
+
+def search_students(term, after_id=0, limit=50):
+    """One keyset page of non-admin users matching `term`, ordered by id: (rows, has_more)."""
+    query = (db.select(User.id, User.name, User.email, User.account_code)
+             .where(User.is_admin == False, User.id > after_id).order_by(User.id).limit(limit + 1))
+    if term:
+        # Trigrams need three characters; shorter terms (and Postgres, via pg_trgm) use ILIKE.
+        if db.engine.dialect.name == 'sqlite' and len(term) >= 3 and user_search_ready():
+            phrase = '"' + term.replace('"', '""') + '"'
+            query = query.where(User.id.in_(db.select(users_search.c.rowid)
+                                            .where(db.text('users_search MATCH :term').bindparams(term=phrase))))
+        else:
+            pattern = f'%{term}%'
+            query = query.where(db.or_(User.name.ilike(pattern), User.email.ilike(pattern), User.account_code.ilike(pattern)))
+    rows = db.session.execute(query).all()
+    return rows[:limit], len(rows) > limit
+
+# --- BULK ENROLLMENT ---
+# A CSV row is `<email or account code>[,<course id>]`; the course id may be left out when a default is given.
+# Rows are resolved and written a chunk at a time, each chunk in its own transaction.
+EnrollmentResult = namedtuple('EnrollmentResult', 'line identifier course_id status detail')
+
+ENROLLMENT_HEADERS = {'email', 'account_code', 'account code', 'student', 'identifier'}
+
+def read_enrollment_csv(text_stream):
+    """Yields (line, identifier, course_id text) from a CSV stream, skipping blank lines and a header row.
+
+    Line 1 is a header when its first cell names the column, or when its course cell is not a number.
+    """
+    for line, row in enumerate(csv.reader(text_stream), start=1):
+        cells = [cell.strip() for cell in row]
+        if not any(cells): continue
+        identifier, course = cells[0], cells[1] if len(cells) > 1 else ''
+        if line == 1 and (identifier.lower() in ENROLLMENT_HEADERS or (course and not course.isdigit())): continue
+        yield line, identifier, course
+
+def _resolve_users(identifiers):
+    """Maps emails and account codes to user ids with one query per kind."""
+    emails = {i for i in identifiers if '@' in i}; codes = set(identifiers) - emails; found = {}
+    if emails: found.update(db.session.execute(db.select(User.email, User.id).where(User.email.in_(emails))).all())
+    if codes: found.update(db.session.execute(db.select(User.account_code, User.id).where(User.account_code.in_(codes))).all())
+    return found
+
+def bulk_enroll(rows, action, default_course_id=None, chunk_size=None):
+    """Grants or revokes course access for (line, identifier, course) rows, yielding an EnrollmentResult per row."""
+    if action not in ('grant', 'revoke'): raise ValueError(f'Unknown enrollment action {action!r}')
+    done = 'granted' if action == 'grant' else 'revoked'
+    courses = get_catalog().courses_by_id; rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size or app.config['BULK_ENROLL_CHUNK']))
+        if not chunk: return
+        user_ids = _resolve_users({identifier for _, identifier, _ in chunk if identifier})
+        pending = {}; results = []
+        for line, identifier, course in chunk:
+            course_id = int(course) if course.isdigit() else default_course_id if not course else None
+            if not identifier: results.append(EnrollmentResult(line, identifier, course, 'failed', 'missing email or account code')); continue
+            if course_id not in courses: results.append(EnrollmentResult(line, identifier, course, 'failed', 'unknown course')); continue
+            if identifier not in user_ids: results.append(EnrollmentResult(line, identifier, course_id, 'failed', 'unknown student')); continue
+            pair = (user_ids[identifier], course_id)
+            if pair in pending: results.append(EnrollmentResult(line, identifier, course_id, 'skipped', 'duplicate row')); continue
+            pending[pair] = (line, identifier)
+        changed = set()
+        if pending:
+            pairs = list(pending)
+            if action == 'grant':
+                stmt = (dialect_insert(StudentCourseAccess).values([{'user_id': u, 'course_id': c} for u, c in pairs])
+                        .on_conflict_do_nothing(index_elements=['user_id', 'course_id']))
+            else:
+                stmt = db.delete(StudentCourseAccess).where(db.tuple_(StudentCourseAccess.user_id, StudentCourseAccess.course_id).in_(pairs))
+            changed = set(db.session.execute(stmt.returning(StudentCourseAccess.user_id, StudentCourseAccess.course_id)).all())
+            db.session.commit()
+            if action == 'revoke': forget_course_access(changed)
+        for (user_id, course_id), (line, identifier) in pending.items():
+            if (user_id, course_id) in changed: results.append(EnrollmentResult(line, identifier, course_id, done, ''))
+            else: results.append(EnrollmentResult(line, identifier, course_id, 'skipped', 'already enrolled' if action == 'grant' else 'not enrolled'))
+        yield from sorted(results)
+
+# --- COURSE PACKAGES ---
+def import_course_package(fileobj):
+    """Creates a new course from a package and returns {'course_id', 'sessions', 'videos', 'quizzes', 'media'}.
+
+    Each distinct media member is streamed once into the media store; rows go in with bulk inserts in a single
+    transaction. If that transaction fails, newly stored files are left for `flask maintenance` to remove.
+    """
+    manifest, archive = open_package(fileobj, ALLOWED_EXTENSIONS)
+    course_data = manifest['course']; sessions = manifest['sessions']
+    with archive:
+        stored = {}
+        for ref in media_refs(manifest):
+            with archive.open(ref) as src: stored[ref] = media_store.stage(src, ref.rsplit('.', 1)[1])
+    resolve = lambda ref: stored[ref].url if is_member(ref) else ref or None
+
+    course = Course(title=course_data['title'], description=course_data['description'], thumbnail_url=resolve(course_data.get('thumbnail')),
+                    status=course_data.get('status') or 'active', duration_weeks=course_data.get('duration_weeks'),
+                    student_count=course_data.get('student_count'))
+    db.session.add(course); db.session.flush()
+    # References first, then the files, as in store_upload; transcode jobs below need the files in place.
+    used = [course_data.get('thumbnail')] + [ref for sess in sessions for ref in [sess.get('thumbnail'), *sess.get('videos', [])]]
+    for ref, count in Counter(ref for ref in used if is_member(ref)).items():
+        retain_media(stored[ref].url, stored[ref].sha256, stored[ref].size, count)
+    for item in stored.values(): media_store.publish(item)
+    if sessions:
+        db.session.execute(db.insert(Session), [
+            {'course_id': course.id, 'title': sess['title'], 'thumbnail_url': resolve(sess.get('thumbnail')),
+             'is_free': bool(sess.get('is_free')), 'video_count': len(sess.get('videos', []))} for sess in sessions])
+    # The course is new, so its sessions are exactly the rows just inserted, and ids follow insertion order.
+    session_ids = db.session.execute(db.select(Session.id).where(Session.course_id == course.id).order_by(Session.id)).scalars().all()
+    hls_status = {item.url: queue_transcode(item.url) for item in stored.values()}  # one job per distinct file
+    videos = [{'session_id': session_id, 'position': position, 'url': resolve(url), 'hls_status': hls_status.get(resolve(url))}
+              for session_id, sess in zip(session_ids, sessions) for position, url in enumerate(sess.get('videos', []), 1)]
+    quizzes = [{'session_id': session_id, 'question': quiz['question'], 'correct_answer': quiz['correct_answer'],
+                **{f'option{n}': option for n, option in enumerate(quiz['options'], 1)}}
+               for session_id, sess in zip(session_ids, sessions) for quiz in sess.get('quizzes', [])]
+    if videos: db.session.execute(db.insert(SessionVideo), videos)
+    if quizzes: db.session.execute(db.insert(Quiz), quizzes)
+    bump_catalog_version(); db.session.commit()
+    for item in stored.values():
+        if is_image(item.url): derivative_pool.submit(media_store.path_for(item.url))
+    return {'course_id': course.id, 'sessions': len(session_ids), 'videos': len(videos), 'quizzes': len(quizzes), 'media': len(stored)}
+
+def export_course_package(course_id):
+    """A streaming iterator over the package bytes for one course, or None if it does not exist.
+
+    Everything is read from the database and checked on disk before the first byte is produced, so a missing
+    upload raises PackageError up front rather than truncating the download.
+    """
+    course = db.session.get(Course, course_id)
+    if course is None: return None
+    sessions = Session.query.filter_by(course_id=course_id).order_by(Session.id).all()
+    session_ids = [sess.id for sess in sessions]; videos = {}; quizzes = {}
+    for session_id, url in db.session.execute(db.select(SessionVideo.session_id, SessionVideo.url)
+                                              .where(SessionVideo.session_id.in_(session_ids)).order_by(SessionVideo.session_id, SessionVideo.position)):
+        videos.setdefault(session_id, []).append(url)
+    for quiz in Quiz.query.filter(Quiz.session_id.in_(session_ids)).order_by(Quiz.id):
+        quizzes.setdefault(quiz.session_id, []).append({'question': quiz.question, 'correct_answer': quiz.correct_answer,
+                                                        'options': [quiz.option1, quiz.option2, quiz.option3, quiz.option4]})
+    media = {}
+    def ref(url):
+        if not media_store.owns(url): return url
+        path = media_store.path_for(url)
+        if not os.path.isfile(path): raise PackageError(f'{url} is missing from the media store.')
+        name = MEDIA_PREFIX + url[len(media_store.url_prefix) + 1:]; media[name] = path
+        return name
+
+    manifest = {
+        'course': {'title': course.title, 'description': course.description, 'thumbnail': ref(course.thumbnail_url), 'status': course.status,
+                   'duration_weeks': course.duration_weeks, 'student_count': course.student_count},
+        'sessions': [{'title': sess.title, 'is_free': bool(sess.is_free), 'thumbnail': ref(sess.thumbnail_url),
+                      'videos': [ref(url) for url in videos.get(sess.id, [])], 'quizzes': quizzes.get(sess.id, [])} for sess in sessions],
+    }
+    return stream_package(manifest, media.items())
+
+# --- ANALYTICS ---
+# Everything is aggregated in SQL; Python only combines a handful of grouped rows with the cached catalog.
+def course_overview():
+    """{course_id: (enrolled, started)} for every course, from two grouped queries."""
+    enrolled = dict(db.session.execute(db.select(StudentCourseAccess.course_id, func.count())
+                                       .group_by(StudentCourseAccess.course_id)).all())
+    started = dict(db.session.execute(db.select(UserSessionProgress.course_id, func.count(UserSessionProgress.user_id.distinct()))
+                                      .where(UserSessionProgress.completed_videos > 0).group_by(UserSessionProgress.course_id)).all())
+    return {course.id: (enrolled.get(course.id, 0), started.get(course.id, 0)) for course in get_catalog().courses}
+
+def course_funnel(course_id):
+    """Students -> started -> completed each session, as [(label, count)]."""
+    catalog = get_catalog(); sessions = catalog.sessions_for(course_id)
+    enrolled = db.session.execute(db.select(func.count()).where(StudentCourseAccess.course_id == course_id)).scalar()
+    started = db.session.execute(db.select(func.count(UserSessionProgress.user_id.distinct())).where(
+        UserSessionProgress.course_id == course_id, UserSessionProgress.completed_videos > 0)).scalar()
+    # Users per (session, videos completed); a session is complete once all of its videos are.
+    completed = {}
+    for session_id, videos, users in db.session.execute(
+            db.select(UserSessionProgress.session_id, UserSessionProgress.completed_videos, func.count())
+            .where(UserSessionProgress.course_id == course_id)
+            .group_by(UserSessionProgress.session_id, UserSessionProgress.completed_videos)):
+        sess = catalog.session(session_id)
+        if sess and sess.video_count and videos >= sess.video_count: completed[session_id] = completed.get(session_id, 0) + users
+    return [('Students', enrolled), ('Started', started)] + [(sess.title, completed.get(sess.id, 0)) for sess in sessions if sess.video_count]
+
+def quiz_distributions(course_id):
+    """{session_id: {'scores': [(best score, students)], 'total': questions, 'attempts': n}} for a course's quizzes."""
+    best = func.coalesce(StudentQuizAttempt.best_score, StudentQuizAttempt.score)
+    rows = db.session.execute(
+        db.select(StudentQuizAttempt.session_id, best, func.max(StudentQuizAttempt.total_questions),
+                  func.count(), func.sum(StudentQuizAttempt.attempt_count))
+        .join(Session, Session.id == StudentQuizAttempt.session_id).where(Session.course_id == course_id)
+        .group_by(StudentQuizAttempt.session_id, best).order_by(StudentQuizAttempt.session_id, best))
+    result = {}
+    for session_id, score, total, students, attempts in rows:
+        entry = result.setdefault(session_id, {'scores': [], 'total': 0, 'attempts': 0})
+        entry['scores'].append((score, students)); entry['total'] = max(entry['total'], total); entry['attempts'] += attempts or 0
+    return result
+
+def export_datasets():
+    """The exportable datasets, as name -> select of labelled columns."""
+    return {
+        'completions': db.select(VideoCompletion.user_id, User.email, User.account_code, Session.course_id,
+                                 VideoCompletion.session_id, VideoCompletion.video_index, VideoCompletion.completed_at)
+                       .join(User, User.id == VideoCompletion.user_id).join(Session, Session.id == VideoCompletion.session_id)
+                       .order_by(VideoCompletion.id),
+        'quiz_results': db.select(StudentQuizAttempt.user_id, User.email, User.account_code, Session.course_id,
+                                  StudentQuizAttempt.session_id, StudentQuizAttempt.score, StudentQuizAttempt.best_score,
+                                  StudentQuizAttempt.total_questions, StudentQuizAttempt.attempt_count, StudentQuizAttempt.attempted_on)
+                        .join(User, User.id == StudentQuizAttempt.user_id).join(Session, Session.id == StudentQuizAttempt.session_id)
+                        .order_by(StudentQuizAttempt.id),
+        'quiz_attempts': db.select(QuizAttemptHistory.user_id, User.email, User.account_code, Session.course_id,
+                                   QuizAttemptHistory.session_id, QuizAttemptHistory.score, QuizAttemptHistory.total_questions,
+                                   QuizAttemptHistory.answers, QuizAttemptHistory.attempted_on)
+                         .join(User, User.id == QuizAttemptHistory.user_id).join(Session, Session.id == QuizAttemptHistory.session_id)
+                         .order_by(QuizAttemptHistory.id),
+    }
+
+def stream_export(stmt, fmt):
+    """Yields the statement's rows as CSV or NDJSON text, a batch at a time from a server-side cursor."""
+    result = db.session.execute(stmt.execution_options(stream_results=True, yield_per=app.config['EXPORT_BATCH_SIZE']))
+    columns = list(result.keys()); buffer = io.StringIO(); writer = csv.writer(buffer)
+    if fmt == 'csv': writer.writerow(columns)
+    for batch in result.partitions():
+        for row in batch:
+            if fmt == 'csv': writer.writerow(row)
+            else: buffer.write(json.dumps(dict(zip(columns, row)), default=str) + '\n')
+        yield buffer.getvalue(); buffer.seek(0); buffer.truncate()
+    yield buffer.getvalue()
+
+# --- SCHEMA MIGRATION ---
+# Unique keys that older databases may hold duplicates of; the oldest row is kept.
+DEDUPE_KEYS = {'video_completions': ('user_id', 'session_id', 'video_index'),
+               'student_course_access': ('user_id', 'course_id'),
+               'student_quiz_attempts': ('user_id', 'session_id')}
+
+def add_missing_columns():
+    """Adds model columns that an older database is missing (create_all only creates whole tables)."""
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name): continue
+        existing = {col['name'] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing: continue
+            col_type = column.type.compile(dialect=db.engine.dialect)
+            default = f" DEFAULT {column.server_default.arg}" if column.server_default is not None else ''
+            not_null = ' NOT NULL' if not column.nullable and default else ''
+            db.session.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}{default}{not_null}'))
+            print(f'Added column {table.name}.{column.name}.')
+    db.session.commit()
+
+LEGACY_VIDEO_COLUMNS = ('video1_url', 'video2_url', 'video3_url', 'video4_url')
+
+def migrate_session_videos():
+    """Moves the old fixed sessions.video1_url..video4_url columns into session_videos, then drops them."""
+    columns = {col['name'] for col in db.inspect(db.engine).get_columns('sessions')}
+    legacy = [name for name in LEGACY_VIDEO_COLUMNS if name in columns]
+    if not legacy: return
+    conn = db.session.connection(); rows = []
+    for session_id, *urls in conn.execute(db.text(f"SELECT id, {', '.join(legacy)} FROM sessions")):
+        # Blank slots were skipped when numbering videos, so positions are assigned over the non-blank ones.
+        rows += [{'session_id': session_id, 'position': n, 'url': url}
+                 for n, url in enumerate((url for url in urls if url and url.strip()), start=1)]
+    if rows: conn.execute(dialect_insert(SessionVideo).on_conflict_do_nothing(), rows)
+    conn.execute(db.update(Session).values(video_count=db.select(func.count()).where(
+        SessionVideo.session_id == Session.id).scalar_subquery()))
+    for name in legacy: conn.execute(db.text(f'ALTER TABLE sessions DROP COLUMN {name}'))
+    db.session.commit()
+    print(f'Moved {len(rows)} session videos into session_videos.')
+
+def _named_indexes(inspector, table_name):
+    return ({ix['name'] for ix in inspector.get_indexes(table_name)} |
+            {uc['name'] for uc in inspector.get_unique_constraints(table_name)})
+
+def create_missing_indexes():
+    """Creates declared indexes and unique constraints (as unique indexes) that the database lacks."""
+    inspector = db.inspect(db.engine); conn = db.session.connection(); removed = {}
+    for table in db.metadata.sorted_tables:
+        existing = _named_indexes(inspector, table.name)
+        for constraint in table.constraints:
+            if not isinstance(constraint, db.UniqueConstraint) or not constraint.name or constraint.name in existing: continue
+            cols = [col.name for col in constraint.columns]
+            if tuple(cols) == DEDUPE_KEYS.get(table.name):
+                removed[table.name] = conn.execute(db.text(
+                    f"DELETE FROM {table.name} WHERE id NOT IN (SELECT MIN(id) FROM {table.name} GROUP BY {', '.join(cols)})")).rowcount
+                if removed[table.name]: print(f'Removed {removed[table.name]} duplicate rows from {table.name}.')
+            conn.execute(db.text(f"CREATE UNIQUE INDEX {constraint.name} ON {table.name} ({', '.join(cols)})"))
+            print(f'Created unique index {constraint.name}.')
+        for index in table.indexes:
+            if index.name in existing: continue
+            index.create(bind=conn); print(f'Created index {index.name}.')
+    db.session.commit()
+    return removed
+
+def migrate_schema():
+    """Upgrades the connected database in place to match the models."""
+    db.create_all(); add_missing_columns(); migrate_session_videos()
+    db.session.execute(db.update(VideoCompletion).where(VideoCompletion.completed_at.is_(None))
+                       .values(completed_at=datetime.datetime.utcnow()))
+    # Best score over any duplicate summary rows, before the duplicates are removed.
+    best = db.aliased(StudentQuizAttempt)
+    db.session.execute(db.update(StudentQuizAttempt).where(StudentQuizAttempt.best_score.is_(None)).values(
+        best_score=db.select(func.max(best.score)).where(best.user_id == StudentQuizAttempt.user_id,
+                                                         best.session_id == StudentQuizAttempt.session_id).scalar_subquery()))
+    removed = create_missing_indexes()
+    # Rollups are rebuilt after duplicate completions were dropped, and when the rollup tables were just created
+    # (or are still empty) for a database that already has completions.
+    rollups_missing = not db.session.execute(db.select(db.exists().select_from(UserSessionProgress))).scalar() and \
+        db.session.execute(db.select(db.exists().select_from(VideoCompletion))).scalar()
+    if removed.get('video_completions') or rollups_missing: rebuild_progress()
+    create_search_index()
+    if not db.session.get(CatalogVersion, 1): db.session.add(CatalogVersion(id=1, version=1))
+    db.session.commit()
+
+def hot_queries(user_id=1, course_id=1, session_id=1):
+    """The lookups behind the student routes, as (label, statement) pairs for EXPLAIN."""
+    return [
+        ('index/courses: access by user', db.select(StudentCourseAccess.course_id).where(StudentCourseAccess.user_id == user_id)),
+        ('course_detail: access check', db.select(StudentCourseAccess.id).where(
+            StudentCourseAccess.user_id == user_id, StudentCourseAccess.course_id == course_id)),
+        ('course_detail: session progress', db.select(UserSessionProgress.session_id, UserSessionProgress.completed_videos).where(
+            UserSessionProgress.user_id == user_id, UserSessionProgress.course_id == course_id)),
+        ('session_detail: completion lookup', db.select(VideoCompletion.id).where(
+            VideoCompletion.user_id == user_id, VideoCompletion.session_id == session_id, VideoCompletion.video_index == 1)),
+        ('session_detail: position lookup', db.select(VideoPosition.position).where(
+            VideoPosition.user_id == user_id, VideoPosition.session_id == session_id, VideoPosition.video_index == 1)),
+        ('mark_video_complete: session rollup', db.select(UserSessionProgress.completed_videos).where(
+            UserSessionProgress.user_id == user_id, UserSessionProgress.session_id == session_id)),
+        ('mark_video_complete: course rollup', db.select(UserCourseProgress.completed_videos).where(
+            UserCourseProgress.user_id == user_id, UserCourseProgress.course_id == course_id)),
+        ('submit_quiz: summary upsert', db.select(StudentQuizAttempt.id).where(
+            StudentQuizAttempt.user_id == user_id, StudentQuizAttempt.session_id == session_id)),
+        ('delete_session: completions by session', db.select(VideoCompletion.id).where(VideoCompletion.session_id == session_id)),
+        ('delete_session: rollups by session', db.select(UserSessionProgress.user_id).where(UserSessionProgress.session_id == session_id)),
+        ('reset_password: token lookup', db.select(PasswordResetToken.id).where(
+            PasswordResetToken.token == 'x', PasswordResetToken.expires_at > datetime.datetime.now())),
+        ('admin_access: student page', db.select(User.id).where(User.is_admin == False, User.id > 0).order_by(User.id).limit(50)),
+        ('maintenance: expired tokens', db.select(PasswordResetToken.id).where(PasswordResetToken.expires_at < datetime.datetime.now())),
+    ]
+
+def explain(stmt):
+    """Returns the plan lines for a statement. On Postgres sequential scans are disabled so a missing index shows up."""
+    conn = db.session.connection()
+    compiled = stmt.compile(dialect=conn.dialect); params = compiled.params
+    if compiled.positional: params = tuple(params[name] for name in compiled.positiontup)
+    if conn.dialect.name == 'sqlite':
+        return [row[-1] for row in conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}', params)]
+    conn.exec_driver_sql('SET LOCAL enable_seqscan = off')
+    return [row[0] for row in conn.exec_driver_sql(f'EXPLAIN {compiled}', params)]
+
+def is_full_scan(plan_line):
+    return plan_line.startswith(('SCAN ', 'SCAN TABLE')) or 'Seq Scan' in plan_line
+
+# --- MAINTENANCE ---
+def purge_expired(batch_size=1000, dry_run=False):
+    """Deletes expired reset tokens and idle (refilled) rate-limit buckets in batches; returns {table: rows}."""
+    now = datetime.datetime.now(); epoch = time.time()
+    expired = {
+        PasswordResetToken: (PasswordResetToken.id, PasswordResetToken.expires_at < now),
+        RateLimitBucket: (RateLimitBucket.key, RateLimitBucket.updated_at +
+                          (RateLimitBucket.capacity - RateLimitBucket.tokens) / RateLimitBucket.refill_rate < epoch),
+    }
+    counts = {}
+    for model, (pk, condition) in expired.items():
+        if dry_run:
+            counts[model.__tablename__] = db.session.execute(db.select(func.count()).select_from(model).where(condition)).scalar(); continue
+        total = 0
+        while True:
+            batch = db.select(pk).where(condition).limit(batch_size).scalar_subquery()
+            deleted = db.session.execute(db.delete(model).where(pk.in_(batch))).rowcount; db.session.commit()
+            total += deleted
+            if deleted < batch_size: break
+        counts[model.__tablename__] = total
+    return counts
+
+def referenced_media():
+    """Every upload url the database points at, plus the url stems whose derivatives and HLS ladders must be kept."""
+    urls = set(db.session.execute(db.select(MediaObject.url)).scalars())
+    for col in media_columns():
+        urls.update(db.session.execute(db.select(col).where(col.like(f'{media_store.url_prefix}/%')).distinct()).scalars())
+    return urls, {url.rsplit('.', 1)[0] for url in urls}
+
+def find_orphan_uploads(min_age=24 * 3600):
+    """Files under the media store that nothing references, as [(path, size)], oldest first.
+
+    Files younger than `min_age` seconds are left alone: an upload is written before the row that references it
+    is committed.
+    """
+    urls, stems = referenced_media(); cutoff = time.time() - min_age; orphans = []
+    for dirpath, dirnames, filenames in os.walk(media_store.root):
+        for name in filenames:
+            path = os.path.join(dirpath, name); st = os.stat(path)
+            if st.st_mtime > cutoff: continue
+            url = f'{media_store.url_prefix}/{os.path.relpath(path, media_store.root).replace(os.sep, "/")}'
+            if path.startswith(media_store.tmp_dir + os.sep):
+                orphans.append((st.st_mtime, path, st.st_size)); continue  # an interrupted upload
+            if url in urls or (is_derivative(url) and derivative_stem(url) in stems) or (is_hls_output(url) and hls_stem(url) in stems): continue
+            orphans.append((st.st_mtime, path, st.st_size))
+    return [(path, size) for _, path, size in sorted(orphans)]
+
+def database_size():
+    if db.engine.dialect.name == 'sqlite':
+        return db.session.execute(db.text('PRAGMA page_count')).scalar() * db.session.execute(db.text('PRAGMA page_size')).scalar()
+    return db.session.execute(db.text('SELECT pg_database_size(current_database())')).scalar()
+
+def vacuum_database():
+    """Runs VACUUM and ANALYZE outside any transaction; returns the bytes reclaimed."""
+    before = database_size(); db.session.commit()
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        if db.engine.dialect.name == 'sqlite':
+            conn.exec_driver_sql('VACUUM'); conn.exec_driver_sql('ANALYZE'); conn.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+        else:
+            conn.exec_driver_sql('VACUUM (ANALYZE)')
+    return before - database_size()
+
+# --- SETUP COMMANDS ---
 @app.cli.command('init-db')
 def init_db_command():
     """Creates all database tables."""
     with app.app_context():
-        db.create_all()
+        migrate_schema()
         if not User.query.filter_by(email='admin@example.com').first():
-            admin_user = User(name='Admin', email='admin@example.com', password=generate_password_hash('admin'),
+            admin_user = User(name='Admin', email='admin@example.com', password=hash_password('admin'),
                               account_code='ADMIN-001', is_admin=True)
             db.session.add(admin_user)
             db.session.commit()
             print('Created default admin user.')
     print('Initialized the database.')
 
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Upgrades an existing database in place: new tables, columns, indexes and constraints."""
+    with app.app_context():
+        migrate_schema()
+    print('Database schema is up to date.')
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    """Runs EXPLAIN on the hot route queries and fails if any of them needs a full table scan."""
+    failures = 0
+    with app.app_context():
+        for label, stmt in hot_queries():
+            try: plan = explain(stmt)
+            except exc.SQLAlchemyError as e:
+                db.session.rollback(); failures += 1
+                print(f"{'ERROR':>9}  {label}: {e.orig if getattr(e, 'orig', None) else e}"); continue
+            scans = [line for line in plan if is_full_scan(line)]
+            failures += bool(scans)
+            print(f"{'FULL SCAN' if scans else 'ok':>9}  {label}: {' | '.join(plan)}")
+            db.session.rollback()
+    if failures:
+        print(f'{failures} hot queries are not using an index. Run `flask migrate-db`.'); raise SystemExit(1)
+    print('All hot queries use an index.')
+
+@app.cli.command('import-media')
+def import_media_command():
+    """Moves legacy uploads referenced by courses and sessions into the content-addressed media store."""
+    with app.app_context():
+        known = set(db.session.execute(db.select(MediaObject.url)).scalars())
+        legacy = set()
+        for col in media_columns():
+            legacy.update(url for url in db.session.execute(db.select(col).where(col.like('uploads/%')).distinct()).scalars())
+        legacy -= known; moved = freed = 0
+        for url in sorted(legacy):
+            path = media_store.path_for(url)
+            if not os.path.exists(path): print(f'Missing file for {url}, skipped.'); continue
+            staged = media_store.stage_file(path); refs = 0
+            for col in media_columns():
+                refs += db.session.execute(db.update(col.class_).where(col == url).values({col.key: staged.url})).rowcount
+            retain_media(staged.url, staged.sha256, staged.size, refs); stored = media_store.publish(staged); release_media(url)
+            moved += 1; freed += 0 if stored.created else stored.size
+        db.session.commit()
+        print(f'Imported {moved} uploads into the media store; {freed} bytes freed by deduplication.')
+
+@app.cli.command('maintenance')
+@click.option('--dry-run', is_flag=True, help='Report what would be removed without changing anything.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows deleted per transaction.')
+@click.option('--min-age', default=24.0, show_default=True, help='Hours an unreferenced upload must be old before it is removed.')
+@click.option('--no-vacuum', is_flag=True, help='Skip VACUUM/ANALYZE.')
+def maintenance_command(dry_run, batch_size, min_age, no_vacuum):
+    """Purges expired tokens and orphaned uploads, then vacuums and analyzes the database."""
+    with app.app_context():
+        verb = 'Would remove' if dry_run else 'Removed'
+        for table, count in purge_expired(batch_size, dry_run).items(): print(f'{verb} {count} expired rows from {table}.')
+        orphans = find_orphan_uploads(min_age * 3600); freed = 0
+        for path, size in orphans:
+            print(f'  {os.path.relpath(path, media_store.root)} ({size} bytes)')
+            if not dry_run:
+                try: os.remove(path)
+                except FileNotFoundError: continue
+            freed += size
+        print(f'{verb} {len(orphans)} orphaned uploads, {freed} bytes.')
+        if no_vacuum: return
+        if dry_run:
+            if db.engine.dialect.name == 'sqlite':
+                free = db.session.execute(db.text('PRAGMA freelist_count')).scalar() * db.session.execute(db.text('PRAGMA page_size')).scalar()
+                print(f'VACUUM would reclaim about {free} bytes of free pages.')
+            return
+        print(f'VACUUM/ANALYZE reclaimed {vacuum_database()} bytes.')
+
+@app.cli.command('import-course')
+@click.argument('package', type=click.File('rb'))
+def import_course_command(package):
+    """Creates a course from a course package zip."""
+    with app.app_context():
+        try:
+            result = import_course_package(package)
+        except PackageError as e:
+            raise click.ClickException(str(e))
+        print(f"Imported course {result['course_id']}: {result['sessions']} sessions, {result['videos']} videos, "
+              f"{result['quizzes']} questions, {result['media']} media files.")
+
+@app.cli.command('export-course')
+@click.argument('course_id', type=int)
+@click.argument('output', type=click.File('wb'))
+def export_course_command(course_id, output):
+    """Writes a course, its sessions, quizzes and media to a course package zip."""
+    with app.app_context():
+        try:
+            package = export_course_package(course_id)
+        except PackageError as e:
+            raise click.ClickException(str(e))
+        if package is None: raise click.ClickException(f'Course {course_id} not found.')
+        for chunk in package: output.write(chunk)
+
+@app.cli.command('build-thumbnails')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True, help='Parallel worker processes.')
+def build_thumbnails_command(workers):
+    """Creates the missing resized derivatives for every image in static/uploads."""
+    sources = [os.path.join(dirpath, name) for dirpath, _, names in os.walk(media_store.root)
+               if not dirpath.startswith(media_store.tmp_dir) for name in names if is_image(name)]
+    written = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for src, paths in zip(sources, pool.map(make_derivatives, sources)):
+            written += len(paths)
+            if paths: print(f'{os.path.relpath(src, media_store.root)}: {len(paths)} derivatives')
+    if written: bump_catalog_version(); db.session.commit()  # retire pages cached without their srcset
+    print(f'Wrote {written} derivatives for {len(sources)} images.')
+
+@app.cli.command('transcode-backlog')
+@click.option('--workers', default=max(1, (os.cpu_count() or 1) // 2), show_default=True, help='ffmpeg processes to run at once.')
+@click.option('--retry-failed', is_flag=True, help='Also retry videos whose transcode failed before.')
+def transcode_backlog_command(workers, retry_failed):
+    """Creates the HLS ladder for every uploaded session video that does not have one yet."""
+    if not ffmpeg_available(): raise click.ClickException('ffmpeg and ffprobe are required (install them or set FFMPEG and FFPROBE).')
+    with app.app_context():
+        pending = SessionVideo.hls_status.is_(None) | (SessionVideo.hls_status == 'queued')
+        if retry_failed: pending |= SessionVideo.hls_status == 'failed'
+        urls = db.session.execute(db.select(SessionVideo.url).where(pending, SessionVideo.url.like(f'{media_store.url_prefix}/%')).distinct()).scalars()
+        sources = {url: media_store.path_for(url) for url in urls if is_video(url)}
+        missing = [url for url, path in sources.items() if not os.path.isfile(path)]
+        for url in missing: print(f'Missing file for {url}, skipped.'); del sources[url]
+    counts = Counter()
+    # Each thread drives one ffmpeg process; statuses are committed per video, so an interrupted run loses nothing.
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(transcode_hls, path, segment_seconds=app.config['HLS_SEGMENT_SECONDS'],
+                               timeout=app.config['TRANSCODE_TIMEOUT']): url for url, path in sources.items()}
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                future.result(); status = 'ready'
+            except TranscodeError as e:
+                status = 'failed'; print(f'{url}: {e}')
+            with app.app_context(): set_hls_status(url, status); db.session.commit()
+            counts[status] += 1; print(f'{url}: {status}')
+    print(f"Transcoded {counts['ready']} of {len(sources)} videos; {counts['failed']} failed.")
+
+@app.cli.command('hash-benchmark')
+@click.option('--method', 'methods', multiple=True, help='werkzeug method strings to time (default: PASSWORD_HASH_METHOD).')
+@click.option('--rounds', default=5, show_default=True, help='Hashes to time per method.')
+def hash_benchmark_command(methods, rounds):
+    """Times password hashing so PASSWORD_HASH_METHOD can be tuned against measured login throughput."""
+    workers = os.cpu_count() or 1
+    for method in methods or [app.config['PASSWORD_HASH_METHOD']]:
+        started = time.perf_counter()
+        for _ in range(rounds): check_password_hash(generate_password_hash('benchmark', method=method), 'benchmark')
+        per_login = (time.perf_counter() - started) / rounds / 2
+        print(f'{method}: {per_login * 1000:.1f} ms per login, about {1 / per_login:.0f} logins/s per core ({workers} cores)')
+
+@app.cli.command('worker')
+@click.option('--threads', default=2, show_default=True, help='Jobs to run concurrently.')
+@click.option('--poll', default=1.0, show_default=True, help='Seconds to sleep when the queue is empty.')
+@click.option('--once', is_flag=True, help='Exit once the queue is drained.')
+def worker_command(threads, poll, once):
+    """Runs background jobs from the jobs table until stopped."""
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM): signal.signal(sig, lambda *_: stop.set())
+
+    def work(n):
+        worker_id = f'{os.uname().nodename}:{os.getpid()}:{n}'
+        with app.app_context():
+            while not stop.is_set():
+                job = claim_job(worker_id)
+                if job is not None: run_job(job); continue
+                if once: return
+                stop.wait(poll)
+            db.session.remove()
+
+    with app.app_context():
+        requeued = requeue_stale_jobs()
+        if requeued: print(f'Requeued {requeued} stale jobs.')
+    pool = [threading.Thread(target=work, args=(n,), name=f'job-worker-{n}') for n in range(threads)]
+    for t in pool: t.start()
+    print(f'Job worker started with {threads} threads.')
+    while any(t.is_alive() for t in pool):
+        for t in pool: t.join(timeout=0.5)
+
+@app.cli.command('jobs')
+@click.option('--requeue-failed', is_flag=True, help='Move failed jobs back to the queue.')
+def jobs_command(requeue_failed):
+    """Shows background job queue depth by kind and status."""
+    with app.app_context():
+        if requeue_failed:
+            count = Job.query.filter_by(status='failed').update({Job.status: 'queued', Job.attempts: 0, Job.run_at: datetime.datetime.utcnow()})
+            db.session.commit(); print(f'Requeued {count} failed jobs.')
+        depth = job_queue_depth()
+        if not depth: print('No jobs.'); return
+        for (kind, status), count in sorted(depth.items()): print(f'{kind:<24} {status:<8} {count}')
+        oldest = db.session.execute(db.select(func.min(Job.run_at)).where(Job.status == 'queued')).scalar()
+        if oldest: print(f'Oldest queued job has been due since {oldest:%Y-%m-%d %H:%M:%S} UTC.')
+
+@app.cli.command('enroll')
+@click.argument('csv_file', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--revoke', is_flag=True, help='Remove access instead of granting it.')
+@click.option('--course', 'course_id', type=int, help='Course id for rows that do not name one.')
+@click.option('--report', type=click.File('w'), default='-', help='Where to write the per-row CSV report.')
+def enroll_command(csv_file, revoke, course_id, report):
+    """Grants (or revokes) course access for every student listed in a CSV of emails or account codes."""
+    writer = csv.writer(report); writer.writerow(EnrollmentResult._fields); totals = {}
+    with app.app_context():
+        for result in bulk_enroll(read_enrollment_csv(csv_file), 'revoke' if revoke else 'grant', course_id):
+            writer.writerow(result); totals[result.status] = totals.get(result.status, 0) + 1
+    click.echo(', '.join(f'{count} {status}' for status, count in sorted(totals.items())) or 'No rows.', err=True)
+
+@app.cli.command('rebuild-progress')
+def rebuild_progress_command():
+    """Rebuilds the per-user progress rollups from video_completions."""
+    with app.app_context():
+        rebuild_progress(); db.session.commit()
+        print(f'Rebuilt progress for {UserSessionProgress.query.count()} user sessions '
+              f'and {UserCourseProgress.query.count()} user courses.')
+
 # --- ROUTES ---
 @app.route('/')
 def index():
-    courses = Course.query.order_by(Course.id).all()
-    accessible_courses = set()
+    catalog = get_catalog()
+    accessible_courses = frozenset()
     if g.user:
-        accessible_courses = {access.course_id for access in StudentCourseAccess.query.filter_by(user_id=g.user.id).all()}
-    return render_template('index.html', courses=courses, accessible_courses=accessible_courses)
+        accessible_courses = frozenset(access.course_id for access in StudentCourseAccess.query.filter_by(user_id=g.user.id).all())
+    viewer = (g.user is not None, g.user is not None and g.user.is_admin)
+    cards_key = ('index-cards', catalog.version, viewer[0], accessible_courses)
+    # Anonymous visitors see nothing but the catalog, so its change time is an exact Last-Modified.
+    return render_conditional('index.html', (catalog.version, viewer, accessible_courses),
+                              catalog.updated_at if g.user is None else None,
+                              courses=catalog.courses, accessible_courses=accessible_courses, cards_key=cards_key)
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         name = request.form['name']; email = request.form['email']; password = request.form['password']
+        limited = throttle('register', email, 'register.html')
+        if limited: return limited
         if User.query.filter_by(email=email).first():
             flash('Email address already registered.', 'error'); return redirect(url_for('register'))
-        new_user = User(name=name, email=email, password=generate_password_hash(password),
+        new_user = User(name=name, email=email, password=hash_password(password),
                         account_code=f"AI-YOUTH-{str(uuid.uuid4().hex[:6]).upper()}")
         db.session.add(new_user); db.session.commit()
         flash('Registration successful! Please log in.', 'success'); return redirect(url_for('login'))
@@ -171,9 +1648,13 @@ def register():
 def login():
     if request.method == 'POST':
         email = request.form['email']; password = request.form['password']
+        limited = throttle('login', email, 'login.html')
+        if limited: return limited
         user = User.query.filter_by(email=email).first()
         if user and check_password_hash(user.password, password):
-            session.clear(); session['user_id'] = user.id; session['is_admin'] = user.is_admin
+            if password_needs_rehash(user.password):
+                user.password = hash_password(password); db.session.commit()
+            session.clear(); session['user_id'] = user.id; session['is_admin'] = user.is_admin; session['auth_version'] = user.auth_version
             return redirect(url_for('admin_dashboard') if user.is_admin else url_for('courses'))
         flash('Invalid email or password.', 'error')
     return render_template('login.html')
@@ -185,11 +1666,24 @@ def logout():
 @app.route('/courses')
 @login_required
 def courses():
-    all_courses = Course.query.order_by(Course.id).all()
-    accessible_courses_ids = {access.course_id for access in StudentCourseAccess.query.filter_by(user_id=g.user.id).all()}
+    accessible_courses_ids = frozenset(db.session.execute(accessible_courses_stmt(g.user.id)).scalars())
+    return courses_page(get_catalog(), accessible_courses_ids)
+
+# The student pages below are split into the queries they need and a page function that renders from the
+# results, so asgi.py can run the same queries on an async session and render through the same code.
+def accessible_courses_stmt(user_id):
+    return db.select(StudentCourseAccess.course_id).where(StudentCourseAccess.user_id == user_id)
+
+def course_access_stmt(user_id, course_id):
+    return db.select(StudentCourseAccess.id).where(StudentCourseAccess.user_id == user_id, StudentCourseAccess.course_id == course_id).limit(1)
+
+def courses_page(catalog, accessible_courses_ids):
+    all_courses = catalog.courses
     enrolled_courses = [course for course in all_courses if course.id in accessible_courses_ids]
     other_courses = [course for course in all_courses if course.id not in accessible_courses_ids]
-    return render_template('courses.html', enrolled_courses=enrolled_courses, other_courses=other_courses)
+    cards_key = ('course-cards', catalog.version, accessible_courses_ids)
+    return render_conditional('courses.html', (catalog.version, g.user.is_admin, accessible_courses_ids),
+                              enrolled_courses=enrolled_courses, other_courses=other_courses, cards_key=cards_key)
 
 @app.route('/request_course_access/<int:course_id>')
 @login_required
@@ -202,87 +1696,163 @@ def request_course_access(course_id):
 @app.route('/course/<int:course_id>')
 @login_required
 def course_detail(course_id):
-    course = db.session.get(Course, course_id)
+    catalog = get_catalog()
+    course = catalog.course(course_id)
     if not course:
         flash('Course not found.', 'error'); return redirect(url_for('courses'))
     
-    has_access = StudentCourseAccess.query.filter_by(user_id=g.user.id, course_id=course_id).first() is not None
-    
-    progress = 0
+    has_access = has_course_access(g.user.id, course_id)
+    session_progress = session_progress_for_course(g.user.id, course_id) if has_access else {}
+    return course_detail_page(catalog, course, has_access, session_progress)
+
+def course_detail_page(catalog, course, has_access, session_progress):
+    course_id = course.id; sessions = catalog.sessions_for(course_id)
+    progress = 0; completed_sessions = set()
     if has_access:
-        user_completions = VideoCompletion.query.filter_by(user_id=g.user.id).all()
-        g.user_completed_videos = {(comp.session_id, comp.video_index) for comp in user_completions}
-        
         total_vids_course = 0; total_comp_vids_course = 0
-        for sess in course.sessions:
-            session_vids = [sess.video1_url, sess.video2_url, sess.video3_url, sess.video4_url]
-            num_vids_in_sess = sum(1 for url in session_vids if url and url.strip())
-            total_vids_course += num_vids_in_sess
-            num_comp_for_this_session = VideoCompletion.query.filter_by(user_id=g.user.id, session_id=sess.id).count()
-            total_comp_vids_course += num_comp_for_this_session
-            sess.is_session_fully_completed = (num_vids_in_sess > 0 and num_comp_for_this_session == num_vids_in_sess)
-        
+        for sess in sessions:
+            num_vids_in_sess = sess.video_count
+            num_comp_for_this_session = min(session_progress.get(sess.id, 0), num_vids_in_sess)
+            total_vids_course += num_vids_in_sess; total_comp_vids_course += num_comp_for_this_session
+            if num_vids_in_sess > 0 and num_comp_for_this_session == num_vids_in_sess: completed_sessions.add(sess.id)
+
         progress = (total_comp_vids_course / total_vids_course) * 100 if total_vids_course > 0 else 0
-        
-    return render_template('course_detail.html', course=course, sessions=course.sessions, progress=progress, has_access=has_access)
+
+    # The session list only depends on whether each session is new, started or completed for this viewer.
+    states = tuple(2 if sess.id in completed_sessions else int(session_progress.get(sess.id, 0) > 0) for sess in sessions)
+    sessions_key = ('session-list', course_id, catalog.version, has_access, states)
+    return render_conditional('course_detail.html', (course_id, catalog.version, g.user.is_admin, has_access, states, round(progress, 6)),
+                              course=course, sessions=sessions, progress=progress, has_access=has_access,
+                              session_progress=session_progress, completed_sessions=completed_sessions, sessions_key=sessions_key)
 
 @app.route('/session/<int:session_id>/video/<int:video_index>')
 @login_required
 def session_detail(session_id, video_index):
-    session_data = db.session.get(Session, session_id)
+    catalog = get_catalog()
+    session_data = catalog.session(session_id)
     if not session_data:
         flash('Session not found.', 'error'); return redirect(url_for('courses'))
 
-    has_course_access = StudentCourseAccess.query.filter_by(user_id=g.user.id, course_id=session_data.course_id).first()
-    if not session_data.is_free and not has_course_access:
+    if not session_data.is_free and not has_course_access(g.user.id, session_data.course_id):
         flash('You must have access to the course to view this protected session.', 'error')
         return redirect(url_for('course_detail', course_id=session_data.course_id))
     
-    vid_urls = [session_data.video1_url, session_data.video2_url, session_data.video3_url, session_data.video4_url]
-    valid_vids = [url for url in vid_urls if url and url.strip()]
-    
-    if not (1 <= video_index <= len(valid_vids)):
+    if not (1 <= video_index <= session_data.video_count):
         flash('Invalid video number.', 'error'); return redirect(url_for('course_detail', course_id=session_data.course_id))
     
-    current_video_url = valid_vids[video_index - 1]
-    completion = VideoCompletion.query.filter_by(user_id=g.user.id, session_id=session_id, video_index=video_index).first()
-    quizzes = Quiz.query.filter_by(session_id=session_id).all()
-    
-    return render_template('session_detail.html', session=session_data, current_video_url=current_video_url,
-                           video_index=video_index, total_videos=len(valid_vids),
-                           is_completed=(completion is not None), quizzes=quizzes)
+    is_completed, position = db.session.execute(video_state_stmt(g.user.id, session_id, video_index)).one()
+    return session_detail_page(catalog, session_data, video_index, is_completed, position)
+
+def video_state_stmt(user_id, session_id, video_index):
+    """(completed, stored playback position) for one user and video, in a single row."""
+    keys = lambda model: (model.user_id == user_id, model.session_id == session_id, model.video_index == video_index)
+    return db.select(db.exists().where(*keys(VideoCompletion)), db.select(VideoPosition.position).where(*keys(VideoPosition)).scalar_subquery())
+
+def session_detail_page(catalog, session_data, video_index, is_completed, position):
+    hls_url = url_for('session_video_hls', session_id=session_data.id, video_index=video_index, name=MASTER_NAME) \
+        if session_data.hls_ready[video_index - 1] else None
+    return render_template('session_detail.html', session=session_data, current_video_url=session_data.video_urls[video_index - 1],
+                           hls_url=hls_url,
+                           video_index=video_index, total_videos=session_data.video_count,
+                           is_completed=bool(is_completed), quizzes=catalog.quizzes_for(session_data.id),
+                           resume_at=resume_position(g.user.id, session_data.id, video_index, position),
+                           heartbeat_interval=app.config['WATCH_HEARTBEAT_INTERVAL'])
+
+@app.route('/media/session/<int:session_id>/video/<int:video_index>')
+@login_required
+def session_video(session_id, video_index):
+    sess = get_catalog().session(session_id)
+    if not sess or not (1 <= video_index <= sess.video_count): abort(404)
+    if not sess.is_free and not has_course_access(g.user.id, sess.course_id): abort(403)
+    url = sess.video_urls[video_index - 1]
+    if not media_store.owns(url): return redirect(url)
+    path = media_store.path_for(url)
+    if not os.path.isfile(path): abort(404)
+
+    # Content-addressed files are named after their SHA-256, which makes a strong ETag for free.
+    digest = os.path.basename(path).rsplit('.', 1)[0]
+    return protected_media_response(path, digest if len(digest) == 64 else True)
+
+@app.route('/media/session/<int:session_id>/video/<int:video_index>/hls/<path:name>')
+@login_required
+def session_video_hls(session_id, video_index, name):
+    """The HLS playlists and segments of an uploaded video; they refer to each other relatively, so all land here."""
+    sess = get_catalog().session(session_id)
+    if not sess or not (1 <= video_index <= sess.video_count) or not sess.hls_ready[video_index - 1]: abort(404)
+    if not sess.is_free and not has_course_access_cached(g.user.id, sess.course_id): abort(403)
+    mimetype = HLS_MIMETYPES.get(name.rsplit('.', 1)[-1])
+    path = safe_join(hls_dir(media_store.path_for(sess.video_urls[video_index - 1])), name)
+    if mimetype is None or path is None or not os.path.isfile(path): abort(404)
+    return protected_media_response(path, True, mimetype)
+
+def protected_media_response(path, etag, mimetype=None):
+    """Sends a file from the media store after the caller has checked access, privately cacheable."""
+    mimetype = mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if app.config['MEDIA_ACCEL'] == 'nginx':
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = app.config['MEDIA_ACCEL_PREFIX'] + os.path.relpath(path, media_store.root).replace(os.sep, '/')
+    else:
+        response = send_file(path, mimetype=mimetype, conditional=True, etag=etag, max_age=app.config['MEDIA_MAX_AGE'])
+    response.cache_control.public = False; response.cache_control.private = True
+    return response
 
 @app.route('/session/<int:session_id>/video/<int:video_index>/mark_complete', methods=['POST'])
 @login_required
 def mark_video_complete(session_id, video_index):
-    if not VideoCompletion.query.filter_by(user_id=g.user.id, session_id=session_id, video_index=video_index).first():
-        new_completion = VideoCompletion(user_id=g.user.id, session_id=session_id, video_index=video_index)
-        db.session.add(new_completion); db.session.commit()
-        flash(f'Video {video_index} marked as complete!', 'success')
+    sess = get_catalog().session(session_id)
+    if not sess: flash('Session not found.', 'error'); return redirect(url_for('courses'))
+    if not (1 <= video_index <= sess.video_count):
+        flash('Invalid video number.', 'error'); return redirect(url_for('course_detail', course_id=sess.course_id))
+    if not sess.is_free and not has_course_access(g.user.id, sess.course_id):
+        flash('You must have access to the course to view this protected session.', 'error')
+        return redirect(url_for('course_detail', course_id=sess.course_id))
+    # Insert-or-ignore: only the request that actually records the completion bumps the rollups.
+    stmt = dialect_insert(VideoCompletion).values(user_id=g.user.id, session_id=session_id, video_index=video_index,
+                                                  completed_at=datetime.datetime.utcnow())
+    inserted = db.session.execute(stmt.on_conflict_do_nothing(index_elements=['user_id', 'session_id', 'video_index'])
+                                  .returning(VideoCompletion.id)).first()
+    if inserted:
+        bump_progress(g.user.id, session_id, sess.course_id)
+        db.session.commit(); flash(f'Video {video_index} marked as complete!', 'success')
+    else:
+        db.session.rollback()
     return redirect(url_for('session_detail', session_id=session_id, video_index=video_index))
 
+@app.route('/session/<int:session_id>/video/<int:video_index>/heartbeat', methods=['POST'])
+@login_required
+def video_heartbeat(session_id, video_index):
+    """Buffers the player's reported position; nothing is written to the database in the request."""
+    sess = get_catalog().session(session_id)
+    if not sess or not (1 <= video_index <= sess.video_count): abort(404)
+    if not sess.is_free and not has_course_access_cached(g.user.id, sess.course_id): abort(403)
+    position = request.form.get('position', type=float); duration = request.form.get('duration', type=float)
+    if position is None or not 0 <= position < 24 * 3600 or (duration is not None and not 0 < duration < 24 * 3600): abort(400)
+    completed = bool(request.form.get('ended')) or bool(duration and position >= duration * app.config['WATCH_COMPLETE_RATIO'])
+    if not watch_buffer.add((g.user.id, session_id, video_index), Heartbeat(position, duration, completed)):
+        return '', 503, {'Retry-After': str(app.config['WATCH_HEARTBEAT_INTERVAL'])}
+    return '', 204
+
 @app.route('/session/<int:session_id>/submit_quiz', methods=['POST'])
 @login_required
 def submit_quiz(session_id):
-    sess = db.session.get(Session, session_id)
+    catalog = get_catalog()
+    sess = catalog.session(session_id)
     if not sess: flash('Session not found.', 'error'); return redirect(url_for('courses'))
-    
-    score = sum(1 for quiz in sess.quizzes if request.form.get(f'quiz_{quiz.id}') and int(request.form.get(f'quiz_{quiz.id}')) == quiz.correct_answer)
-    
-    attempt = StudentQuizAttempt.query.filter_by(user_id=g.user.id, session_id=session_id).first()
-    if attempt is None:
-        new_attempt = StudentQuizAttempt(user_id=g.user.id, session_id=session_id, score=score, total_questions=len(sess.quizzes))
-        db.session.add(new_attempt)
-    else:
-        attempt.score = score; attempt.total_questions = len(sess.quizzes); attempt.attempted_on = datetime.datetime.utcnow()
-    
-    db.session.commit(); flash(f'Quiz submitted! You scored {score}/{len(sess.quizzes)}.', 'success')
+    if not sess.is_free and not has_course_access(g.user.id, sess.course_id):
+        flash('You must have access to the course to view this protected session.', 'error')
+        return redirect(url_for('course_detail', course_id=sess.course_id))
+
+    answer_key = catalog.answer_key(session_id)
+    score, answers = grade_quiz(answer_key, request.form)
+    record_quiz_attempt(g.user.id, session_id, score, len(answer_key), answers)
+
+    db.session.commit(); flash(f'Quiz submitted! You scored {score}/{len(answer_key)}.', 'success')
     return redirect(url_for('course_detail', course_id=sess.course_id))
 
 @app.route('/session/<int:session_id>/finish_session')
 @login_required
 def finish_session(session_id):
-    sess = db.session.get(Session, session_id)
+    sess = get_catalog().session(session_id)
     if not sess: flash('Session not found.', 'error'); return redirect(url_for('courses'))
     return render_template('finish_page.html', session=sess)
 
@@ -292,8 +1862,16 @@ def contact(): return render_template('contact.html')
 @app.route('/profile')
 @login_required
 def profile():
-    enrolled_courses = Course.query.join(StudentCourseAccess).filter(StudentCourseAccess.user_id == g.user.id).all()
-    return render_template('profile.html', user=g.user, enrolled_courses=enrolled_courses)
+    accessible_courses_ids = frozenset(db.session.execute(accessible_courses_stmt(g.user.id)).scalars())
+    completed = dict(db.session.execute(course_progress_stmt(g.user.id, accessible_courses_ids)).all())
+    return profile_page(get_catalog(), db.session.get(User, g.user.id), accessible_courses_ids, completed)
+
+def profile_page(catalog, user, accessible_courses_ids, completed):
+    """Video totals come from the cached catalog, so only the completion rollups are queried."""
+    enrolled_courses = [course for course in catalog.courses if course.id in accessible_courses_ids]
+    totals = {course.id: sum(sess.video_count for sess in catalog.sessions_for(course.id)) for course in enrolled_courses}
+    course_progress = progress_percentages(totals, completed, [course.id for course in enrolled_courses])
+    return render_template('profile.html', user=user, enrolled_courses=enrolled_courses, course_progress=course_progress)
 
 @app.route('/forgot_password', methods=['GET', 'POST'])
 def forgot_password():
@@ -303,10 +1881,11 @@ def forgot_password():
         if user:
             token = secrets.token_urlsafe(16)
             expires_at = datetime.datetime.now() + datetime.timedelta(hours=1)
-            new_token = PasswordResetToken(user_id=user.id, token=token, expires_at=expires_at)
-            db.session.add(new_token); db.session.commit()
+            # The token and the email job commit together: a saved token always has its email queued.
+            db.session.add(PasswordResetToken(user_id=user.id, token=token, expires_at=expires_at))
             reset_url = url_for('reset_password', token=token, _external=True)
-            print(f"--- PASSWORD RESET LINK (SIMULATED EMAIL): {reset_url} ---")
+            enqueue_job('send_password_reset', {'email': user.email, 'reset_url': reset_url}, key=f'password-reset:{token}')
+            db.session.commit()
         flash('If an account with that email exists, a reset link has been sent (check console).', 'info')
         return redirect(url_for('login'))
     return render_template('forgot_password.html')
@@ -322,7 +1901,7 @@ def reset_password(token):
             flash('Passwords do not match.', 'error'); return render_template('reset_password.html', token=token)
         
         user = db.session.get(User, token_data.user_id)
-        user.password = generate_password_hash(password)
+        user.password = hash_password(password); invalidate_user_sessions(user)
         db.session.delete(token_data); db.session.commit()
         flash('Password has been reset successfully. Please log in.', 'success'); return redirect(url_for('login'))
     return render_template('reset_password.html', token=token)
@@ -342,12 +1921,9 @@ def admin_add_course():
             flash('Thumbnail file is required.', 'error'); return redirect(request.url)
         file = request.files['thumbnail']
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            if not os.path.exists(app.config['UPLOAD_FOLDER']): os.makedirs(app.config['UPLOAD_FOLDER'])
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            thumb_path = f'uploads/{filename}'
+            thumb_path = store_image_upload(file)
             new_course = Course(title=title, description=desc, thumbnail_url=thumb_path, status=status, duration_weeks=duration, student_count=students)
-            db.session.add(new_course); db.session.commit()
+            db.session.add(new_course); bump_catalog_version(); db.session.commit()
             flash(f"Course '{title}' added!", 'success'); return redirect(url_for('courses'))
         else: flash('Invalid thumbnail file type.', 'error'); return redirect(request.url)
     return render_template('admin_add_course.html')
@@ -364,13 +1940,10 @@ def admin_edit_course(course_id):
         if 'thumbnail' in request.files:
             file = request.files['thumbnail']
             if file and file.filename and allowed_file(file.filename):
-                if course.thumbnail_url and course.thumbnail_url.startswith('uploads/'):
-                    try: os.remove(os.path.join(app.root_path, 'static', course.thumbnail_url))
-                    except OSError as e: print(f"Error deleting old thumbnail: {e}")
-                filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename)); course.thumbnail_url = f'uploads/{filename}'
+                old_thumb = course.thumbnail_url
+                course.thumbnail_url = store_image_upload(file); release_media(old_thumb)
         
-        db.session.commit()
+        bump_catalog_version(); db.session.commit()
         flash(f"Course '{course.title}' updated!", 'success'); return redirect(url_for('admin_manage_courses'))
     return render_template('edit_course.html', course=course)
 
@@ -386,50 +1959,65 @@ def admin_delete_course(course_id):
     course = db.session.get(Course, course_id)
     if not course: flash('Course not found.', 'error'); return redirect(url_for('admin_manage_courses'))
     
-    if course.thumbnail_url and course.thumbnail_url.startswith('uploads/'):
-        try: os.remove(os.path.join(app.root_path, 'static', course.thumbnail_url))
-        except OSError as e: print(f"Error deleting course thumbnail: {e}")
-
-    for sess in course.sessions:
-        for i in range(1, 5):
-            video_url = getattr(sess, f'video{i}_url')
-            if video_url and video_url.startswith('uploads/'):
-                try: os.remove(os.path.join(app.root_path, 'static', video_url))
-                except OSError as e: print(f"Error deleting session video: {e}")
-    
-    db.session.delete(course); db.session.commit()
+    media_urls = [course.thumbnail_url] + [url for sess in course.sessions for url in [sess.thumbnail_url] + sess.video_urls]
+    db.session.delete(course); db.session.flush()
+    for url in media_urls: release_media(url)
+    bump_catalog_version(); db.session.commit()
     flash('Course and all related content deleted.', 'success')
     return redirect(url_for('admin_manage_courses'))
 
+@app.route('/admin/import_course', methods=['POST'])
+@admin_required
+def admin_import_course():
+    package = request.files.get('package')
+    if not package or not package.filename:
+        flash('Choose a course package to import.', 'error'); return redirect(url_for('admin_manage_courses'))
+    try:
+        result = import_course_package(package.stream)
+    except PackageError as e:
+        flash(str(e), 'error'); return redirect(url_for('admin_manage_courses'))
+    flash(f"Course imported with {result['sessions']} sessions, {result['videos']} videos and {result['quizzes']} questions.", 'success')
+    return redirect(url_for('admin_manage_courses'))
+
+@app.route('/admin/export_course/<int:course_id>')
+@admin_required
+def admin_export_course(course_id):
+    try:
+        package = export_course_package(course_id)
+    except PackageError as e:
+        flash(str(e), 'error'); return redirect(url_for('admin_manage_courses'))
+    if package is None: flash('Course not found.', 'error'); return redirect(url_for('admin_manage_courses'))
+    return Response(package, mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename=course-{course_id}-{datetime.date.today():%Y%m%d}.zip'})
+
 @app.route('/admin/add_session', methods=['GET', 'POST'])
 @admin_required
 def admin_add_session():
-    courses_list = Course.query.filter_by(status='active').order_by(Course.title).all()
+    courses_list = sorted((c for c in get_catalog().courses if c.status == 'active'), key=lambda c: c.title)
     if request.method == 'POST':
         course_id = request.form.get('course_id'); title = request.form.get('title'); is_free = 1 if request.form.get('is_free') == '1' else 0
         thumb_path = None
         if 'thumbnail_file' in request.files:
             thumb_file = request.files['thumbnail_file']
             if thumb_file and thumb_file.filename and allowed_file(thumb_file.filename):
-                thumb_filename = secure_filename(thumb_file.filename)
-                thumb_file.save(os.path.join(app.config['UPLOAD_FOLDER'], thumb_filename)); thumb_path = f'uploads/{thumb_filename}'
+                thumb_path = store_image_upload(thumb_file)
         
-        paths = [None] * 4
-        for i in range(1, 5):
+        paths = []
+        for i in submitted_video_slots():
             video_type = request.form.get(f'video{i}_type')
-            if video_type == 'url' and request.form.get(f'video{i}_url', '').strip(): paths[i-1] = request.form.get(f'video{i}_url').strip()
+            if video_type == 'url' and request.form.get(f'video{i}_url', '').strip(): paths.append(request.form.get(f'video{i}_url').strip())
             elif video_type == 'upload' and f'video{i}_file' in request.files:
                 file = request.files[f'video{i}_file']
                 if file and file.filename and allowed_file(file.filename):
-                    filename = secure_filename(file.filename)
-                    file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename)); paths[i-1] = f'uploads/{filename}'
+                    paths.append(store_upload(file))
         
-        if not all([course_id, title, paths[0]]):
-            flash('Course, Title, and Video 1 are required.', 'error')
+        if not all([course_id, title, paths]):
+            db.session.rollback()  # drop the references taken on any uploads
+            flash('Course, Title, and at least one video are required.', 'error')
         else:
-            new_session = Session(course_id=int(course_id), title=title, thumbnail_url=thumb_path, is_free=is_free,
-                                  video1_url=paths[0], video2_url=paths[1], video3_url=paths[2], video4_url=paths[3])
-            db.session.add(new_session); db.session.commit()
+            new_session = Session(course_id=int(course_id), title=title, thumbnail_url=thumb_path, is_free=is_free)
+            set_session_videos(new_session, paths)
+            db.session.add(new_session); bump_catalog_version(); db.session.commit()
             flash(f"Session '{title}' added!", 'success'); return redirect(url_for('course_detail', course_id=int(course_id)))
     return render_template('admin_add_session.html', courses=courses_list)
 
@@ -443,32 +2031,32 @@ def admin_edit_session(session_id):
         if 'thumbnail_file' in request.files:
             thumb_file = request.files['thumbnail_file']
             if thumb_file and thumb_file.filename and allowed_file(thumb_file.filename):
-                if sess.thumbnail_url and sess.thumbnail_url.startswith('uploads/'):
-                    try: os.remove(os.path.join(app.root_path, 'static', sess.thumbnail_url))
-                    except OSError as e: print(f"Error deleting old session thumbnail: {e}")
-                thumb_filename = secure_filename(thumb_file.filename)
-                thumb_file.save(os.path.join(app.config['UPLOAD_FOLDER'], thumb_filename)); sess.thumbnail_url = f'uploads/{thumb_filename}'
+                old_thumb = sess.thumbnail_url
+                sess.thumbnail_url = store_image_upload(thumb_file); release_media(old_thumb)
         
-        for i in range(1, 5):
+        # Existing videos keep their position (completions refer to it); new ones are appended.
+        urls = list(sess.video_urls); replaced = []
+        for i in submitted_video_slots():
             new_url = request.form.get(f'video{i}_url', '').strip(); file = request.files.get(f'video{i}_file')
-            current_path = getattr(sess, f'video{i}_url')
             if file and file.filename:
-                if allowed_file(file.filename):
-                    if current_path and current_path.startswith('uploads/'):
-                        try: os.remove(os.path.join(app.root_path, 'static', current_path))
-                        except OSError as e: print(f"Error deleting old video file: {e}")
-                    filename = secure_filename(file.filename)
-                    file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename)); setattr(sess, f'video{i}_url', f'uploads/{filename}')
-            elif new_url:
-                if current_path and current_path.startswith('uploads/'):
-                    try: os.remove(os.path.join(app.root_path, 'static', current_path))
-                    except OSError as e: print(f"Error deleting old video file: {e}")
-                setattr(sess, f'video{i}_url', new_url)
+                if not allowed_file(file.filename): continue
+                new_url = store_upload(file)
+            if not new_url: continue
+            if i <= len(urls): replaced.append(urls[i - 1]); urls[i - 1] = new_url
+            else: urls.append(new_url)
+        set_session_videos(sess, urls)
+        for url in replaced: release_media(url)
         
-        db.session.commit()
+        bump_catalog_version(); db.session.commit()
         flash(f"Session '{sess.title}' updated!", 'success'); return redirect(url_for('admin_manage_sessions'))
     return render_template('edit_session.html', session=sess)
 
+def submitted_video_slots():
+    """The video slot numbers present in the submitted session form, in order."""
+    slots = {int(key[5:].split('_', 1)[0]) for key in list(request.form) + list(request.files)
+             if key.startswith('video') and key[5:].split('_', 1)[0].isdigit()}
+    return sorted(slots)
+
 @app.route('/admin/manage_sessions')
 @admin_required
 def admin_manage_sessions():
@@ -481,30 +2069,25 @@ def admin_delete_session(session_id):
     sess = db.session.get(Session, session_id)
     if not sess: flash('Session not found.', 'error'); return redirect(url_for('admin_manage_sessions'))
     
-    for i in range(1, 5):
-        video_url = getattr(sess, f'video{i}_url')
-        if video_url and video_url.startswith('uploads/'):
-            try: os.remove(os.path.join(app.root_path, 'static', video_url))
-            except OSError as e: print(f"Error deleting session video: {e}")
-    if sess.thumbnail_url and sess.thumbnail_url.startswith('uploads/'):
-        try: os.remove(os.path.join(app.root_path, 'static', sess.thumbnail_url))
-        except OSError as e: print(f"Error deleting session thumbnail: {e}")
-    
-    db.session.delete(sess); db.session.commit()
+    media_urls = [sess.thumbnail_url] + sess.video_urls
+    drop_session_progress(sess.id, sess.course_id)
+    db.session.delete(sess); db.session.flush()
+    for url in media_urls: release_media(url)
+    bump_catalog_version(); db.session.commit()
     flash('Session has been deleted.', 'success')
     return redirect(url_for('admin_manage_sessions'))
 
 @app.route('/admin/add_quiz', methods=['GET', 'POST'])
 @admin_required
 def admin_add_quiz():
-    sessions = Session.query.join(Course).order_by(Course.title, Session.title).all()
+    sessions = sorted(get_catalog().sessions_by_id.values(), key=lambda s: (s.course_title, s.title))
     if request.method == 'POST':
         sess_id = request.form['session_id']; q = request.form['question']
         opts = [request.form[f'option{i}'] for i in range(1,5)]; correct = request.form['correct_answer']
         if not all([sess_id, q] + opts + [correct]):
             flash('All quiz fields are required.', 'error'); return render_template('admin_add_quiz.html', sessions=sessions)
         new_quiz = Quiz(session_id=sess_id, question=q, option1=opts[0], option2=opts[1], option3=opts[2], option4=opts[3], correct_answer=int(correct))
-        db.session.add(new_quiz); db.session.commit()
+        db.session.add(new_quiz); bump_catalog_version(); db.session.commit()
         flash('Quiz added.', 'success'); return redirect(url_for('admin_dashboard'))
     return render_template('admin_add_quiz.html', sessions=sessions)
 
@@ -517,7 +2100,7 @@ def admin_grant_access():
         db.session.add(new_access); db.session.commit()
         flash('Access granted.', 'success')
     else: flash('User already has access to this course.', 'info')
-    return redirect(url_for('admin_manage_access', search=request.form.get('current_search', '')))
+    return redirect(access_page_url())
 
 @app.route('/admin/remove_access', methods=['POST'])
 @admin_required
@@ -525,23 +2108,80 @@ def admin_remove_access():
     user_id = request.form['user_id']; course_id = request.form['course_id']
     access_record = StudentCourseAccess.query.filter_by(user_id=user_id, course_id=course_id).first()
     if access_record:
-        db.session.delete(access_record); db.session.commit()
+        db.session.delete(access_record); db.session.commit(); forget_course_access([(user_id, course_id)])
         flash('Access removed successfully.', 'success')
-    return redirect(url_for('admin_manage_access', search=request.form.get('current_search', '')))
+    return redirect(access_page_url())
+
+@app.route('/admin/bulk_access', methods=['GET', 'POST'])
+@admin_required
+def admin_bulk_access():
+    all_courses = sorted(get_catalog().courses, key=lambda c: c.title)
+    if request.method == 'POST':
+        upload = request.files.get('csv_file'); action = request.form.get('action', 'grant')
+        if not upload or not upload.filename or action not in ('grant', 'revoke'):
+            flash('Choose a CSV file and an action.', 'error'); return redirect(url_for('admin_bulk_access'))
+        rows = read_enrollment_csv(io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline=''))
+        results = list(bulk_enroll(rows, action, request.form.get('course_id', type=int)))
+        totals = {}
+        for result in results: totals[result.status] = totals.get(result.status, 0) + 1
+        return render_template('admin_bulk_access.html', all_courses=all_courses, results=results, totals=totals, action=action)
+    return render_template('admin_bulk_access.html', all_courses=all_courses, results=None)
+
+@app.route('/admin/analytics')
+@admin_required
+def admin_analytics():
+    overview = course_overview()
+    return render_template('admin_analytics.html', courses=get_catalog().courses, overview=overview,
+                           datasets=sorted(export_datasets()))
+
+@app.route('/admin/analytics/<int:course_id>')
+@admin_required
+def admin_course_analytics(course_id):
+    course = get_catalog().course(course_id)
+    if not course: flash('Course not found.', 'error'); return redirect(url_for('admin_analytics'))
+    return render_template('admin_course_analytics.html', course=course, funnel=course_funnel(course_id),
+                           sessions=get_catalog().sessions_for(course_id), distributions=quiz_distributions(course_id))
+
+@app.route('/admin/export/<dataset>.<fmt>')
+@admin_required
+def admin_export(dataset, fmt):
+    stmt = export_datasets().get(dataset)
+    if stmt is None or fmt not in ('csv', 'ndjson'): abort(404)
+    course_id = request.args.get('course_id', type=int)
+    if course_id: stmt = stmt.where(Session.course_id == course_id)
+    filename = f"{dataset}{f'-course-{course_id}' if course_id else ''}-{datetime.date.today():%Y%m%d}.{fmt}"
+    return Response(stream_with_context(stream_export(stmt, fmt)),
+                    mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@app.route('/admin/metrics')
+@admin_required
+def admin_metrics():
+    """Request, SQL and render metrics summed over every worker, in Prometheus text format."""
+    jobs = {(('kind', kind), ('status', status)): count for (kind, status), count in job_queue_depth().items()}
+    return Response(metrics.render([('jobs', 'Jobs in the queue table by kind and status.', jobs)]),
+                    mimetype='text/plain; version=0.0.4')
+
+def access_page_url():
+    """The access page the admin posted from, so grants and removals keep the search and page."""
+    return url_for('admin_manage_access', search=request.form.get('current_search', '') or None,
+                   after=request.form.get('current_after', type=int) or None)
 
 @app.route('/admin/access')
 @admin_required
 def admin_manage_access():
-    search_q = request.args.get('search', '')
-    query = User.query.filter(User.is_admin == False)
-    if search_q:
-        search_term = f'%{search_q}%'
-        query = query.filter(db.or_(User.name.ilike(search_term), User.email.ilike(search_term), User.account_code.ilike(search_term)))
-    
-    students = query.options(joinedload(User.courses).joinedload(StudentCourseAccess.course)).all()
-    all_courses = Course.query.order_by(Course.title).all()
-    
-    return render_template('admin_access.html', students=students, all_courses=all_courses, search_query=search_q)
+    search_q = request.args.get('search', '').strip(); after = request.args.get('after', 0, type=int)
+    students, has_more = search_students(search_q, after, app.config['ADMIN_ACCESS_PAGE_SIZE'])
+    # Access flags for the visible page only.
+    access = {}
+    if students:
+        rows = db.session.execute(db.select(StudentCourseAccess.user_id, StudentCourseAccess.course_id)
+                                  .where(StudentCourseAccess.user_id.in_([s.id for s in students])))
+        for user_id, course_id in rows: access.setdefault(user_id, set()).add(course_id)
+    all_courses = sorted(get_catalog().courses, key=lambda c: c.title)
+    next_after = students[-1].id if has_more else None
+    return render_template('admin_access.html', students=students, all_courses=all_courses, access=access,
+                           search_query=search_q, after=after, next_after=next_after)
 
 if __name__ == '__main__':
     with app.app_context():
@@ -0,0 +1,169 @@
+"""ASGI entry point: the read-heavy student pages on async SQLAlchemy, everything else through the Flask app.
+
+    uvicorn asgi:application --workers 4
+    gunicorn -k uvicorn.workers.UvicornWorker -w 4 asgi:application
+
+`courses`, `course_detail`, `session_detail` and `profile` are served natively: their queries run on an
+AsyncSession, so a worker keeps serving other connections while one waits on the database or a slow client.
+They share the models, the cached catalog and the page functions with app.py. Every request they do not
+cover -- other routes and methods, logged-out visitors, a missing course or missing course access -- goes to
+the Flask app unchanged through asgiref's WsgiToAsgi, so redirects and flash messages behave exactly as
+under `gunicorn app:app`.
+
+Needs asgiref and an async driver: aiosqlite for SQLite, asyncpg for Postgres. ASYNC_DATABASE_URL overrides
+the URL derived from DATABASE_URL.
+"""
+import asyncio
+import io
+import os
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import g, session
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app import (app, db, catalog_cache, get_catalog, user_cache, engine_options, UserRecord, User, RequestStats,
+                 _apply_sqlite_pragmas, _before_cursor_execute, _after_cursor_execute, user_record_stmt,
+                 accessible_courses_stmt, course_access_stmt, session_progress_stmt, video_state_stmt, course_progress_stmt,
+                 courses_page, course_detail_page, session_detail_page, profile_page)
+
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+
+
+def create_engine():
+    """An async engine on the same database as the WSGI app, with the same SQLite pragmas or pool profile."""
+    with app.app_context(): url = db.engine.url  # Flask-SQLAlchemy has already resolved relative SQLite paths
+    backend = url.get_backend_name()
+    options = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+    if options.pop('connect_args', None):  # asyncpg takes server settings rather than libpq options
+        options['connect_args'] = {'server_settings': {'statement_timeout': os.environ.get('DB_STATEMENT_TIMEOUT', '30000')}}
+    engine = create_async_engine(os.environ.get('ASYNC_DATABASE_URL') or url.set(drivername=ASYNC_DRIVERS[backend]), **options)
+    if backend == 'sqlite': event.listen(engine.sync_engine, 'connect', _apply_sqlite_pragmas)
+    event.listen(engine.sync_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine.sync_engine, 'after_cursor_execute', _after_cursor_execute)
+    return engine
+
+
+async def current_catalog():
+    # The version check is a tiny synchronous query, due at most every CATALOG_CHECK_INTERVAL seconds.
+    return catalog_cache.peek() or await asyncio.to_thread(get_catalog)
+
+
+async def current_user(db_session):
+    """The logged-in UserRecord, checked like before_request does; None hands the request to Flask."""
+    user_id = session.get('user_id'); auth_version = session.get('auth_version')
+    if user_id is None or auth_version is None: return None
+    record = user_cache.get((user_id, auth_version))
+    if record is None:
+        row = (await db_session.execute(user_record_stmt(user_id))).first()
+        if row is None or row.auth_version != auth_version: return None
+        record = UserRecord(*row)
+        user_cache.set((record.id, record.auth_version), record)
+    return record
+
+
+async def has_access(db_session, course_id):
+    return (await db_session.execute(course_access_stmt(g.user.id, course_id))).first() is not None
+
+
+# Each view returns a response, or None when Flask should answer instead (with its redirect and flash message).
+async def courses_view(db_session):
+    accessible_courses_ids = frozenset((await db_session.execute(accessible_courses_stmt(g.user.id))).scalars())
+    return courses_page(await current_catalog(), accessible_courses_ids)
+
+
+async def course_detail_view(db_session, course_id):
+    catalog = await current_catalog(); course = catalog.course(course_id)
+    if not course: return None
+    access = await has_access(db_session, course_id)
+    session_progress = dict((await db_session.execute(session_progress_stmt(g.user.id, course_id))).all()) if access else {}
+    return course_detail_page(catalog, course, access, session_progress)
+
+
+async def session_detail_view(db_session, session_id, video_index):
+    catalog = await current_catalog(); session_data = catalog.session(session_id)
+    if not session_data or not (1 <= video_index <= session_data.video_count): return None
+    if not session_data.is_free and not await has_access(db_session, session_data.course_id): return None
+    is_completed, position = (await db_session.execute(video_state_stmt(g.user.id, session_id, video_index))).one()
+    return session_detail_page(catalog, session_data, video_index, is_completed, position)
+
+
+async def profile_view(db_session):
+    accessible_courses_ids = frozenset((await db_session.execute(accessible_courses_stmt(g.user.id))).scalars())
+    completed = dict((await db_session.execute(course_progress_stmt(g.user.id, accessible_courses_ids))).all())
+    user = await db_session.get(User, g.user.id)
+    return profile_page(await current_catalog(), user, accessible_courses_ids, completed)
+
+
+def wsgi_environ(scope):
+    """The WSGI environ Flask needs to build a request context for a bodiless ASGI GET."""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'], 'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'), 'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_NAME': server_name, 'SERVER_PORT': str(server_port), 'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0], 'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(), 'wsgi.errors': io.StringIO(), 'wsgi.multithread': True, 'wsgi.multiprocess': True,
+        'wsgi.run_once': False, 'wsgi.version': (1, 0),
+    }
+    for name, value in scope.get('headers', []):
+        key = 'HTTP_' + name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if key in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'): key = key[5:]
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+ASYNC_VIEWS = {'courses': courses_view, 'course_detail': course_detail_view,
+               'session_detail': session_detail_view, 'profile': profile_view}
+
+
+class AsyncStudentApp:
+    def __init__(self, flask_app, engine):
+        self.flask_app = flask_app
+        self.engine = engine
+        self.sessions = async_sessionmaker(engine, expire_on_commit=False)
+        self.wsgi = WsgiToAsgi(flask_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            response = await self.serve(scope)
+            if response is not None:
+                return await self.send_response(response, send)
+        await self.wsgi(scope, receive, send)
+
+    async def serve(self, scope):
+        environ = wsgi_environ(scope)
+        try:
+            endpoint, view_args = self.flask_app.url_map.bind_to_environ(environ).match()
+        except Exception:
+            return None  # 404s, redirects and the like are Flask's to answer
+        view = ASYNC_VIEWS.get(endpoint)
+        if view is None: return None
+        with self.flask_app.request_context(environ):
+            g.request_stats = RequestStats()
+            async with self.sessions() as db_session:
+                g.user = await current_user(db_session)
+                if g.user is None: return None
+                response = await view(db_session, **view_args)
+            if response is None: return None
+            return self.flask_app.process_response(self.flask_app.make_response(response))
+
+    async def send_response(self, response, send):
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response.headers.items()]
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': response.get_data()})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'}); return
+
+
+application = AsyncStudentApp(app, create_engine())
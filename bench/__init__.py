@@ -0,0 +1,8 @@
+"""Synthetic data and load benchmarks for the student and admin routes.
+
+    python -m bench.datagen --users 50000 --courses 200 --sessions 40 --reset
+    python -m bench.driver --requests 500 --baseline bench/baseline.json
+    python -m bench.driver --gunicorn 4 --concurrency 16 --save bench/baseline.json
+
+Both use DATABASE_URL like the app itself; point it at a scratch database.
+"""
@@ -0,0 +1,115 @@
+"""Fills the database with a synthetic school at a configurable scale.
+
+Rows are written with bulk Core inserts in batches, and the derived tables
+(progress rollups, search index) are rebuilt the same way the app does it.
+Every student gets the password BENCH_PASSWORD; the admin is admin@bench.test.
+"""
+import datetime
+import random
+import time
+
+import click
+from sqlalchemy import insert
+
+from app import (app, db, hash_password, migrate_schema, rebuild_progress, bump_catalog_version, User, Course, Session, SessionVideo,
+                 Quiz, StudentCourseAccess, VideoCompletion, StudentQuizAttempt, QuizAttemptHistory)
+
+BENCH_PASSWORD = 'bench'
+ADMIN_EMAIL = 'admin@bench.test'
+BATCH_SIZE = 20000
+
+
+def student_email(n):
+    return f'student{n}@bench.test'
+
+
+def _insert(model, rows):
+    """Bulk-inserts an iterable of dicts in batches; returns the number of rows written."""
+    batch = []; written = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            db.session.execute(insert(model), batch); written += len(batch); batch = []
+    if batch: db.session.execute(insert(model), batch); written += len(batch)
+    db.session.commit()
+    return written
+
+
+def _reset():
+    db.drop_all()
+    if db.engine.dialect.name == 'sqlite': db.session.execute(db.text('DROP TABLE IF EXISTS users_search'))
+    db.session.commit()
+
+
+def generate(users, courses, sessions, videos, enroll, completion, quizzes, seed):
+    rng = random.Random(seed); now = datetime.datetime.utcnow(); counts = {}
+    password = hash_password(BENCH_PASSWORD)
+
+    counts['users'] = _insert(User, [{'name': 'Bench Admin', 'email': ADMIN_EMAIL, 'password': password,
+                                      'account_code': 'BENCH-ADMIN', 'is_admin': True, 'auth_version': 1}] +
+                              [{'name': f'Student {n}', 'email': student_email(n), 'password': password,
+                                'account_code': f'BENCH-{n:06d}', 'is_admin': False, 'auth_version': 1} for n in range(users)])
+    counts['courses'] = _insert(Course, ({'title': f'Course {c}', 'description': f'Synthetic course {c}.', 'status': 'active',
+                                          'duration_weeks': rng.randint(2, 12), 'student_count': 0} for c in range(courses)))
+    course_ids = db.session.execute(db.select(Course.id).order_by(Course.id)).scalars().all()
+    counts['sessions'] = _insert(Session, ({'course_id': cid, 'title': f'Session {s}', 'is_free': s == 0, 'video_count': videos}
+                                           for cid in course_ids for s in range(sessions)))
+    session_rows = db.session.execute(db.select(Session.id, Session.course_id).order_by(Session.id)).all()
+    counts['session_videos'] = _insert(SessionVideo, ({'session_id': sid, 'position': p, 'url': f'https://www.youtube.com/embed/bench{sid}-{p}'}
+                                                      for sid, _ in session_rows for p in range(1, videos + 1)))
+    counts['quizzes'] = _insert(Quiz, ({'session_id': sid, 'question': f'Question {q}?', 'option1': 'A', 'option2': 'B',
+                                        'option3': 'C', 'option4': 'D', 'correct_answer': rng.randint(1, 4)}
+                                       for sid, _ in session_rows for q in range(quizzes)))
+
+    sessions_by_course = {}
+    for sid, cid in session_rows: sessions_by_course.setdefault(cid, []).append(sid)
+    student_ids = db.session.execute(db.select(User.id).where(User.is_admin == False).order_by(User.id)).scalars().all()
+    enrollments = [(uid, cid) for uid in student_ids for cid in rng.sample(course_ids, min(enroll, len(course_ids)))]
+    counts['student_course_access'] = _insert(StudentCourseAccess, ({'user_id': uid, 'course_id': cid} for uid, cid in enrollments))
+
+    def completions():
+        for uid, cid in enrollments:
+            for sid in sessions_by_course[cid]:
+                if rng.random() >= completion: continue
+                for index in range(1, rng.randint(1, videos) + 1):
+                    yield {'user_id': uid, 'session_id': sid, 'video_index': index, 'completed_at': now}
+    counts['video_completions'] = _insert(VideoCompletion, completions())
+
+    attempts = [(uid, sid, rng.randint(0, quizzes), rng.randint(1, 3)) for uid, cid in enrollments if quizzes
+                for sid in sessions_by_course[cid] if rng.random() < completion / 2]
+    counts['student_quiz_attempts'] = _insert(StudentQuizAttempt, (
+        {'user_id': uid, 'session_id': sid, 'score': score, 'best_score': score, 'total_questions': quizzes,
+         'attempt_count': n, 'attempted_on': now} for uid, sid, score, n in attempts))
+    counts['quiz_attempt_history'] = _insert(QuizAttemptHistory, (
+        {'user_id': uid, 'session_id': sid, 'score': score, 'total_questions': quizzes, 'answers': '{}', 'attempted_on': now}
+        for uid, sid, score, n in attempts for _ in range(n)))
+
+    rebuild_progress(); bump_catalog_version(); db.session.commit()
+    return counts
+
+
+@click.command()
+@click.option('--users', default=5000, show_default=True, help='Students to create.')
+@click.option('--courses', default=50, show_default=True)
+@click.option('--sessions', default=20, show_default=True, help='Sessions per course.')
+@click.option('--videos', default=4, show_default=True, help='Videos per session.')
+@click.option('--enroll', default=3, show_default=True, help='Courses each student is enrolled in.')
+@click.option('--completion', default=0.5, show_default=True, help='Share of enrolled sessions a student has started.')
+@click.option('--quizzes', default=3, show_default=True, help='Quiz questions per session.')
+@click.option('--seed', default=1, show_default=True, help='Random seed; the same arguments always produce the same data.')
+@click.option('--reset', is_flag=True, help='Drop every table first.')
+def main(users, courses, sessions, videos, enroll, completion, quizzes, seed, reset):
+    """Generates synthetic benchmark data in the database at DATABASE_URL."""
+    started = time.perf_counter()
+    with app.app_context():
+        if reset: _reset()
+        migrate_schema()
+        if User.query.filter_by(email=ADMIN_EMAIL).first():
+            raise click.ClickException('The database already holds benchmark data; pass --reset to start over.')
+        counts = generate(users, courses, sessions, videos, enroll, completion, quizzes, seed)
+    for table, count in counts.items(): click.echo(f'{table:<24} {count:>10}')
+    click.echo(f'Generated in {time.perf_counter() - started:.1f}s.')
+
+
+if __name__ == '__main__':
+    main()
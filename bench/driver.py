@@ -0,0 +1,219 @@
+"""Drives the hot routes and reports latency percentiles, throughput and SQL queries per request.
+
+By default requests go through the Flask test client in this process, which also lets every request's SQL
+statements be counted. With --target (or --gunicorn, which starts a local server first) they go over HTTP
+with a pool of threads; query counts are then not available.
+
+Results can be saved as a baseline and later runs compared against it: a route whose p95 grows beyond the
+tolerance, or that issues more queries than before, is reported as a regression and the exit status is 1.
+"""
+import http.cookiejar
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from sqlalchemy import event
+
+from app import app, db, get_catalog, StudentCourseAccess, User
+from bench.datagen import ADMIN_EMAIL, BENCH_PASSWORD
+
+Fixture = namedtuple('Fixture', 'email course_id session_id video_count answer_key')
+RouteResult = namedtuple('RouteResult', 'requests errors p50 p95 p99 rps queries')
+
+
+def load_fixtures(students):
+    """One enrolled course and session per benchmark student, read from the generated data."""
+    fixtures = []
+    with app.app_context():
+        catalog = get_catalog()
+        rows = db.session.execute(
+            db.select(User.email, StudentCourseAccess.course_id).join(StudentCourseAccess, StudentCourseAccess.user_id == User.id)
+            .where(User.email.like('student%@bench.test')).order_by(User.id, StudentCourseAccess.course_id)).all()
+        seen = set()
+        for email, course_id in rows:
+            sessions = [s for s in catalog.sessions_for(course_id) if s.video_count and catalog.answer_key(s.id)]
+            if email in seen or not sessions: continue
+            sess = sessions[len(fixtures) % len(sessions)]; seen.add(email)
+            fixtures.append(Fixture(email, course_id, sess.id, sess.video_count, catalog.answer_key(sess.id)))
+            if len(fixtures) == students: break
+    if not fixtures: raise click.ClickException('No benchmark data found; run `python -m bench.datagen` first.')
+    return fixtures
+
+
+def routes():
+    """(name, role, request builder) for every benchmarked route; builders return (method, path, form data)."""
+    return [
+        ('index', 'student', lambda f, i: ('GET', '/', None)),
+        ('courses', 'student', lambda f, i: ('GET', '/courses', None)),
+        ('course_detail', 'student', lambda f, i: ('GET', f'/course/{f.course_id}', None)),
+        ('session_detail', 'student', lambda f, i: ('GET', f'/session/{f.session_id}/video/1', None)),
+        ('mark_video_complete', 'student', lambda f, i: (
+            'POST', f'/session/{f.session_id}/video/{i % f.video_count + 1}/mark_complete', {})),
+        ('submit_quiz', 'student', lambda f, i: (
+            'POST', f'/session/{f.session_id}/submit_quiz', {f'quiz_{qid}': str((qid + i) % 4 + 1) for qid, _ in f.answer_key})),
+        ('admin_manage_access', 'admin', lambda f, i: ('GET', f'/admin/access?search={f.email[:9]}', None)),
+    ]
+
+
+class TestClientTransport:
+    """Runs requests in-process and counts the SQL statements each one executes."""
+
+    def __init__(self):
+        self.queries = 0
+        app.config['LOGIN_RATE_PER_IP'] = ''  # every fixture logs in from the same address
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.queries += 1
+
+    def login(self, email):
+        client = app.test_client()
+        response = client.post('/login', data={'email': email, 'password': BENCH_PASSWORD})
+        if response.status_code != 302: raise click.ClickException(f'Could not log in as {email}.')
+        return client
+
+    def request(self, client, method, path, data):
+        self.queries = 0
+        response = client.open(path, method=method, data=data)
+        response.close()
+        return response.status_code, self.queries
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPTransport:
+    """Sends requests to a running server, one cookie jar per logged-in user."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def login(self, email):
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect)
+        status, _ = self.request(opener, 'POST', '/login', {'email': email, 'password': BENCH_PASSWORD})
+        if status != 302: raise click.ClickException(f'Could not log in as {email} (HTTP {status}).')
+        return opener
+
+    def request(self, opener, method, path, data):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            with opener.open(urllib.request.Request(self.base_url + path, data=body, method=method), timeout=60) as response:
+                response.read(); return response.status, None
+        except urllib.error.HTTPError as e:
+            return e.code, None
+
+
+def run_route(transport, clients, fixtures, build, requests, warmup, concurrency):
+    def one(i):
+        fixture = fixtures[i % len(fixtures)]
+        method, path, data = build(fixture, i)
+        started = time.perf_counter()
+        status, queries = transport.request(clients[fixture.email], method, path, data)
+        return (time.perf_counter() - started) * 1000, status, queries
+
+    for i in range(warmup): one(i)
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as pool: samples = list(pool.map(one, range(warmup, warmup + requests)))
+    else:
+        samples = [one(i) for i in range(warmup, warmup + requests)]
+    elapsed = time.perf_counter() - started
+    latencies = sorted(s[0] for s in samples)
+    cuts = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    queries = [s[2] for s in samples if s[2] is not None]
+    return RouteResult(len(samples), sum(1 for s in samples if s[1] >= 400), round(cuts[49], 2), round(cuts[94], 2),
+                       round(cuts[98], 2), round(len(samples) / elapsed, 1), round(statistics.mean(queries), 2) if queries else None)
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of regression messages against a saved baseline."""
+    problems = []
+    for name, base in baseline.get('routes', {}).items():
+        current = results.get(name)
+        if current is None: continue
+        if current.p95 > base['p95'] * (1 + tolerance):
+            problems.append(f"{name}: p95 {current.p95}ms vs baseline {base['p95']}ms (+{current.p95 / base['p95'] - 1:.0%})")
+        if current.queries is not None and base.get('queries') is not None and current.queries > base['queries'] + 0.5:
+            problems.append(f"{name}: {current.queries} queries/request vs baseline {base['queries']}")
+    return problems
+
+
+def _wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None: raise click.ClickException('gunicorn exited during startup.')
+        with socket.socket() as sock:
+            if sock.connect_ex(('127.0.0.1', port)) == 0: return
+        time.sleep(0.2)
+    raise click.ClickException('gunicorn did not start in time.')
+
+
+@click.command()
+@click.option('--requests', 'count', default=200, show_default=True, help='Measured requests per route.')
+@click.option('--warmup', default=20, show_default=True, help='Unmeasured requests per route first.')
+@click.option('--students', default=20, show_default=True, help='Distinct logged-in students to spread requests over.')
+@click.option('--concurrency', default=1, show_default=True, help='Parallel requests (HTTP mode only).')
+@click.option('--target', help='Base URL of a running server instead of the in-process test client.')
+@click.option('--gunicorn', 'workers', type=int, help='Start a local gunicorn with this many workers and benchmark it.')
+@click.option('--port', default=8765, show_default=True, help='Port for --gunicorn.')
+@click.option('--route', 'only', multiple=True, help='Benchmark only these routes.')
+@click.option('--save', type=click.Path(dir_okay=False), help='Write the results as a baseline file.')
+@click.option('--baseline', type=click.Path(dir_okay=False), help='Compare against this baseline; regressions exit 1.')
+@click.option('--tolerance', default=0.25, show_default=True, help='Allowed p95 growth over the baseline.')
+def main(count, warmup, students, concurrency, target, workers, port, only, save, baseline, tolerance):
+    """Benchmarks the hot routes against the benchmark data in DATABASE_URL."""
+    fixtures = load_fixtures(students); server = None
+    if workers:
+        server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}', 'app:app'],
+                                  env=dict(os.environ, LOG_LEVEL='WARNING', LOGIN_RATE_PER_IP='0'))
+        _wait_for_port(port, server); target = f'http://127.0.0.1:{port}'
+    try:
+        transport = HTTPTransport(target) if target else TestClientTransport()
+        if not target: concurrency = 1
+        clients = {f.email: transport.login(f.email) for f in fixtures}
+        admin = transport.login(ADMIN_EMAIL)
+        results = {}
+        click.echo(f"{'route':<22}{'reqs':>6}{'errors':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>9}{'queries':>9}")
+        for name, role, build in routes():
+            if only and name not in only: continue
+            route_clients = clients if role == 'student' else {f.email: admin for f in fixtures}
+            result = results[name] = run_route(transport, route_clients, fixtures, build, count, warmup, concurrency)
+            click.echo(f'{name:<22}{result.requests:>6}{result.errors:>7}{result.p50:>9}{result.p95:>9}{result.p99:>9}'
+                       f"{result.rps:>9}{'-' if result.queries is None else result.queries:>9}")
+    finally:
+        if server is not None: server.terminate(); server.wait()
+
+    report = {'mode': target and 'http' or 'test-client', 'concurrency': concurrency, 'requests': count,
+              'routes': {name: result._asdict() for name, result in results.items()}}
+    if save:
+        with open(save, 'w') as f: json.dump(report, f, indent=2)
+        click.echo(f'Saved baseline to {save}.')
+    failed = False
+    if any(result.errors for result in results.values()):
+        click.echo('Some requests failed.', err=True); failed = True
+    if baseline:
+        with open(baseline) as f: base = json.load(f)
+        if base.get('mode') != report['mode']: click.echo(f"Warning: baseline was recorded in {base.get('mode')} mode.", err=True)
+        problems = compare(results, base, tolerance)
+        for problem in problems: click.echo(f'REGRESSION {problem}', err=True)
+        if not problems: click.echo(f'No regressions against {baseline}.')
+        failed = failed or bool(problems)
+    if failed: sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""In-process cache of the course catalog (courses, sessions and quizzes).
+
+Every worker keeps its own immutable snapshot of the catalog. A snapshot is
+tagged with the catalog version it was loaded at; the cache re-reads that
+version (one tiny query) at most every `check_interval` seconds and reloads
+the whole snapshot when an admin write has bumped it.
+"""
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+CourseRecord = namedtuple('CourseRecord', 'id title description thumbnail_url status duration_weeks student_count')
+SessionRecord = namedtuple('SessionRecord', 'id course_id course_title title thumbnail_url is_free video_urls video_count hls_ready')
+QuizRecord = namedtuple('QuizRecord', 'id session_id question option1 option2 option3 option4 correct_answer')
+
+
+class Catalog:
+    """An immutable snapshot of the catalog at a given version."""
+
+    def __init__(self, version, courses, sessions, quizzes, updated_at=None):
+        self.version = version
+        self.updated_at = updated_at
+        self.courses = tuple(sorted(courses, key=lambda c: c.id))
+        self.courses_by_id = MappingProxyType({c.id: c for c in self.courses})
+        self.sessions_by_id = MappingProxyType({s.id: s for s in sessions})
+        by_course, by_session = {}, {}
+        for sess in sorted(sessions, key=lambda s: s.id):
+            by_course.setdefault(sess.course_id, []).append(sess)
+        for quiz in sorted(quizzes, key=lambda q: q.id):
+            by_session.setdefault(quiz.session_id, []).append(quiz)
+        self._sessions_by_course = MappingProxyType({k: tuple(v) for k, v in by_course.items()})
+        self._quizzes_by_session = MappingProxyType({k: tuple(v) for k, v in by_session.items()})
+        # Compact grading keys: ((quiz id, correct option), ...) per session.
+        self._answer_keys = MappingProxyType({k: tuple((q.id, q.correct_answer) for q in v) for k, v in by_session.items()})
+
+    def course(self, course_id):
+        return self.courses_by_id.get(course_id)
+
+    def session(self, session_id):
+        return self.sessions_by_id.get(session_id)
+
+    def sessions_for(self, course_id):
+        return self._sessions_by_course.get(course_id, ())
+
+    def quizzes_for(self, session_id):
+        return self._quizzes_by_session.get(session_id, ())
+
+    def answer_key(self, session_id):
+        return self._answer_keys.get(session_id, ())
+
+
+class CatalogCache:
+    """Serves `Catalog` snapshots, reloading them when the stored version changes.
+
+    `loader(version)` must return a fresh `Catalog`; `version_reader()` must
+    return the current catalog version from the database.
+    """
+
+    def __init__(self, loader, version_reader, check_interval=2.0):
+        self._loader = loader
+        self._read_version = version_reader
+        self.check_interval = check_interval
+        self._catalog = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        catalog = self._catalog
+        now = time.monotonic()
+        if catalog is not None and now - self._checked_at < self.check_interval:
+            return catalog
+        version = self._read_version()
+        with self._lock:
+            if self._catalog is None or self._catalog.version != version:
+                self._catalog = self._loader(version)
+            self._checked_at = now
+            return self._catalog
+
+    def peek(self):
+        """The current snapshot if it is not due for a version check, else None; never touches the database."""
+        catalog = self._catalog
+        if catalog is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return catalog
+        return None
+
+    def invalidate(self):
+        with self._lock:
+            self._catalog = None
@@ -0,0 +1,119 @@
+"""Course packages: a whole course (sessions, videos, quizzes and media) in one zip file.
+
+A package holds `manifest.json` plus the media it references under `media/`:
+
+    {"format": "skillify-course", "version": 1,
+     "course": {"title": ..., "description": ..., "status": ..., "duration_weeks": ..., "student_count": ...,
+                "thumbnail": "media/ab/ab12....jpg"},
+     "sessions": [{"title": ..., "is_free": false, "thumbnail": null,
+                   "videos": ["media/cd/cd34....mp4", "https://www.youtube.com/embed/..."],
+                   "quizzes": [{"question": ..., "options": [4 strings], "correct_answer": 1}]}]}
+
+Media references starting with `media/` name a member of the zip; anything else (an external video URL) is
+kept as-is. This module only reads and writes the format; mapping it to database rows is the caller's job.
+"""
+import json
+import zipfile
+
+FORMAT = 'skillify-course'
+VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+MEDIA_PREFIX = 'media/'
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class PackageError(ValueError):
+    pass
+
+
+def is_member(ref):
+    return isinstance(ref, str) and ref.startswith(MEDIA_PREFIX)
+
+
+def media_refs(manifest):
+    """Every archive member the manifest references, in order of first use."""
+    refs = [manifest['course'].get('thumbnail')]
+    for sess in manifest['sessions']:
+        refs.append(sess.get('thumbnail')); refs.extend(sess.get('videos', ()))
+    return list(dict.fromkeys(ref for ref in refs if is_member(ref)))
+
+
+def _require(condition, message):
+    if not condition: raise PackageError(message)
+
+
+def validate(manifest, members, allowed_extensions):
+    """Checks a manifest before anything is written; raises PackageError naming the first problem."""
+    _require(isinstance(manifest, dict) and manifest.get('format') == FORMAT, 'Not a course package.')
+    _require(manifest.get('version') == VERSION, f"Unsupported package version {manifest.get('version')!r}.")
+    course = manifest.get('course'); sessions = manifest.get('sessions')
+    _require(isinstance(course, dict) and course.get('title') and course.get('description') is not None,
+             'The course needs a title and a description.')
+    _require(isinstance(sessions, list), 'The package has no session list.')
+    for n, sess in enumerate(sessions, 1):
+        _require(isinstance(sess, dict) and sess.get('title'), f'Session {n} has no title.')
+        _require(isinstance(sess.get('videos', []), list) and isinstance(sess.get('quizzes', []), list),
+                 f'Session {n} has a malformed video or quiz list.')
+        _require(all(isinstance(url, str) and url.strip() for url in sess.get('videos', [])), f'Session {n} has a blank video.')
+        for q, quiz in enumerate(sess.get('quizzes', []), 1):
+            _require(isinstance(quiz, dict) and quiz.get('question'), f'Question {q} of session {n} has no text.')
+            options = quiz.get('options')
+            _require(isinstance(options, list) and len(options) == 4 and all(isinstance(o, str) and o for o in options),
+                     f'Question {q} of session {n} needs exactly 4 options.')
+            _require(quiz.get('correct_answer') in (1, 2, 3, 4), f'Question {q} of session {n} has no valid correct answer.')
+    for ref in media_refs(manifest):
+        _require(ref in members, f'{ref} is referenced but not in the package.')
+        _require(ref.rsplit('.', 1)[-1].lower() in allowed_extensions, f'{ref} is not an allowed media type.')
+
+
+def open_package(fileobj, allowed_extensions):
+    """Opens a package for reading and returns (manifest, zipfile); media is read later via `zipfile.open`."""
+    try:
+        archive = zipfile.ZipFile(fileobj)
+        manifest = json.loads(archive.read(MANIFEST_NAME))
+    except (zipfile.BadZipFile, KeyError, ValueError) as e:
+        raise PackageError(f'Not a readable course package: {e}') from e
+    validate(manifest, set(archive.namelist()), allowed_extensions)
+    return manifest, archive
+
+
+class _Sink:
+    """A write-only file that hands what was written so far to the streaming generator."""
+
+    def __init__(self):
+        self._chunks = []; self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data)); self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks); self._chunks = []
+        return data
+
+
+def stream_package(manifest, media):
+    """Yields a package as zip bytes while it is being written.
+
+    `media` is an iterable of (member name, path on disk). Media is stored uncompressed since images and videos
+    already are; the manifest is deflated.
+    """
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w') as archive:
+        manifest = dict(manifest, format=FORMAT, version=VERSION)
+        archive.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2), compress_type=zipfile.ZIP_DEFLATED)
+        for name, path in media:
+            with open(path, 'rb') as src, archive.open(zipfile.ZipInfo.from_file(path, name), 'w', force_zip64=True) as dest:
+                while True:
+                    chunk = src.read(COPY_CHUNK_SIZE)
+                    if not chunk: break
+                    dest.write(chunk)
+                    data = sink.drain()
+                    if data: yield data
+    yield sink.drain()  # the last member's header fix-up and the central directory
@@ -1,5 +1,4 @@
-from app import app, db, User # Import your app, db instance, and User model
-from werkzeug.security import generate_password_hash
+from app import app, db, User, hash_password, invalidate_user_sessions # Import your app, db instance, and User model
 
 # --- CONFIGURATION ---
 ADMIN_EMAIL = 'admin@example.com'
@@ -19,7 +18,9 @@ with app.app_context():
         if user:
             print("User found. Generating new password hash...")
             # Update the user object's password attribute
-            user.password = generate_password_hash(NEW_PASSWORD)
+            user.password = hash_password(NEW_PASSWORD)
+            # Log out every existing session of this account
+            invalidate_user_sessions(user)
             
             # Commit the change to the database
             db.session.commit()
@@ -0,0 +1,106 @@
+"""Resized WebP/JPEG derivatives of uploaded thumbnails.
+
+A derivative lives next to its original as `<name>.w<width>.<format>`, so it
+can always be found (and cleaned up) from the original's path alone.
+Pillow is optional: without it no derivatives are made and pages keep
+serving the originals.
+"""
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+DERIVATIVE_WIDTHS = (320, 640, 1280)
+DERIVATIVE_FORMATS = ('webp', 'jpeg')
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+_DERIVATIVE_RE = re.compile(r'\.w\d+\.(webp|jpeg)$')
+
+
+def is_image(path):
+    return path.rsplit('.', 1)[-1].lower() in IMAGE_EXTENSIONS and not is_derivative(path)
+
+
+def is_derivative(path):
+    return bool(_DERIVATIVE_RE.search(path))
+
+
+def derivative_stem(path):
+    """The original's path minus its extension, for a derivative path."""
+    return _DERIVATIVE_RE.sub('', path)
+
+
+def derivative_path(path, width, fmt):
+    return f'{path.rsplit(".", 1)[0]}.w{width}.{fmt}'
+
+
+def derivative_paths(path, widths=DERIVATIVE_WIDTHS, formats=DERIVATIVE_FORMATS):
+    return [derivative_path(path, width, fmt) for width in widths for fmt in formats]
+
+
+def make_derivatives(src_path, widths=DERIVATIVE_WIDTHS, formats=DERIVATIVE_FORMATS, quality=80):
+    """Writes the missing derivatives of one image and returns the paths written.
+
+    Widths at or above the original's are skipped; images are never upscaled.
+    """
+    if Image is None or not os.path.isfile(src_path):
+        return []
+    written = []
+    src_mtime = os.path.getmtime(src_path)
+    with Image.open(src_path) as original:
+        image = ImageOps.exif_transpose(original)
+        for width in widths:
+            if width >= image.width:
+                continue
+            targets = [(fmt, derivative_path(src_path, width, fmt)) for fmt in formats]
+            targets = [(fmt, out) for fmt, out in targets
+                       if not os.path.exists(out) or os.path.getmtime(out) < src_mtime]
+            if not targets:
+                continue
+            resized = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+            for fmt, out in targets:
+                frame = resized if fmt == 'webp' else resized.convert('RGB')
+                tmp_path = f'{out}.tmp'
+                frame.save(tmp_path, format=fmt.upper(), quality=quality, optimize=True)
+                os.replace(tmp_path, out)
+                written.append(out)
+    return written
+
+
+def remove_derivatives(src_path):
+    for path in derivative_paths(src_path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class DerivativePool:
+    """A small bounded thread pool so upload requests return before resizing finishes."""
+
+    def __init__(self, max_workers=2, on_error=None, on_done=None):
+        self.max_workers = max_workers
+        self._on_error = on_error
+        self._on_done = on_done
+        self._executor = None
+
+    def submit(self, src_path):
+        if Image is None:
+            return None
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='thumbnails')
+        future = self._executor.submit(make_derivatives, src_path)
+        future.add_done_callback(lambda f: self._finished(src_path, f))
+        return future
+
+    def _finished(self, src_path, future):
+        """Reports a failure to `on_error`, or the paths written to `on_done`."""
+        error = future.exception()
+        if error is not None:
+            if self._on_error is not None:
+                self._on_error(src_path, error)
+        elif self._on_done is not None:
+            self._on_done(src_path, future.result())
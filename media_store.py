@@ -0,0 +1,95 @@
+"""Content-addressed storage for uploaded media.
+
+Uploads are streamed to a temporary file in fixed-size chunks while being
+hashed, then atomically renamed to `<url_prefix>/<sha[:2]>/<sha>.<ext>`.
+Identical files therefore land on the same path and are stored only once.
+The store itself knows nothing about who references a file; callers keep
+reference counts and ask it to remove a file once nothing points at it.
+
+A caller that may race with such a removal stages the upload, takes its
+reference, and only then publishes it: publishing puts the staged copy in
+place if the file has been removed in the meantime.
+"""
+import hashlib
+import os
+import tempfile
+from collections import namedtuple
+
+StoredFile = namedtuple('StoredFile', 'url sha256 size created')
+StagedFile = namedtuple('StagedFile', 'url sha256 size tmp_path')
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+class MediaStore:
+    def __init__(self, root, url_prefix='uploads', chunk_size=DEFAULT_CHUNK_SIZE):
+        self.root = os.path.abspath(root)
+        self.url_prefix = url_prefix.strip('/')
+        self.chunk_size = chunk_size
+        self.tmp_dir = os.path.join(self.root, '.tmp')
+
+    def save(self, stream, ext):
+        """Streams `stream` into the store and returns a `StoredFile`."""
+        return self.publish(self.stage(stream, ext))
+
+    def stage(self, stream, ext):
+        """Streams `stream` to a temporary file and returns a `StagedFile`; `publish` or `discard` it afterwards."""
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        hasher = hashlib.sha256(); size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    chunk = stream.read(self.chunk_size)
+                    if not chunk: break
+                    hasher.update(chunk); out.write(chunk); size += len(chunk)
+                out.flush(); os.fsync(out.fileno())
+        except BaseException:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+        digest = hasher.hexdigest()
+        return StagedFile(f'{self.url_prefix}/{digest[:2]}/{digest}.{ext.lower()}', digest, size, tmp_path)
+
+    def publish(self, staged):
+        """Moves a staged file into place unless an identical one is already there; returns a `StoredFile`."""
+        final_path = self.path_for(staged.url)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        created = not os.path.exists(final_path)
+        if created: os.replace(staged.tmp_path, final_path)
+        else: self.discard(staged)
+        return StoredFile(staged.url, staged.sha256, staged.size, created)
+
+    def discard(self, staged):
+        try:
+            os.remove(staged.tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def save_file(self, path):
+        ext = path.rsplit('.', 1)[-1]
+        with open(path, 'rb') as f:
+            return self.save(f, ext)
+
+    def stage_file(self, path):
+        ext = path.rsplit('.', 1)[-1]
+        with open(path, 'rb') as f:
+            return self.stage(f, ext)
+
+    def owns(self, url):
+        return bool(url) and url.startswith(self.url_prefix + '/')
+
+    def path_for(self, url):
+        """Maps a stored url back to its absolute path, refusing anything outside the store."""
+        if not self.owns(url): raise ValueError(f'{url!r} is not in the media store')
+        path = os.path.abspath(os.path.join(self.root, url[len(self.url_prefix) + 1:]))
+        if os.path.commonpath([path, self.root]) != self.root: raise ValueError(f'{url!r} escapes the media store')
+        return path
+
+    def remove(self, url):
+        """Deletes a stored file; returns the number of bytes freed."""
+        path = self.path_for(url)
+        try:
+            size = os.path.getsize(path); os.remove(path)
+        except FileNotFoundError:
+            return 0
+        return size
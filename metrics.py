@@ -0,0 +1,226 @@
+"""Per-endpoint request metrics, shared across worker processes through a directory of snapshots.
+
+Each process accumulates counters and histograms in memory and periodically writes them to
+`<directory>/<pid>-<token>.json` (the token keeps a reused pid from overwriting an older worker's file).
+Rendering sums every snapshot in the directory (with this process's live numbers in place of its own file),
+so any worker can serve the totals for all of them. A worker folds its totals into `archived.json` and
+removes its file when it exits; files of workers that died without doing so are folded by the next scrape.
+Counters therefore never go backwards, and the directory only holds live workers. The directory must be
+local to one host, since liveness is checked by pid.
+"""
+import fcntl
+import json
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)
+
+
+class RequestStats:
+    """What a single request spent its time on."""
+    __slots__ = ('started', 'queries', 'db_time', 'render_time', 'slow_queries')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0; self.db_time = 0.0; self.render_time = 0.0; self.slow_queries = 0
+
+
+def _new_entry():
+    return {'requests': {}, 'latency': {}, 'queries_per_request': {}, 'queries': 0, 'db_seconds': 0.0, 'render_seconds': 0.0,
+            'slow_queries': 0}
+
+
+def _merge(total, snapshot):
+    """Adds one snapshot's endpoints into `total` in place."""
+    for endpoint, entry in snapshot.items():
+        merged = total.setdefault(endpoint, _new_entry())
+        for key, count in entry['requests'].items(): merged['requests'][key] = merged['requests'].get(key, 0) + count
+        for name in ('latency', 'queries_per_request'):
+            source = entry[name]; target = merged[name]
+            if not source: continue
+            target['buckets'] = [a + b for a, b in zip(target.get('buckets', [0] * len(source['buckets'])), source['buckets'])]
+            target['sum'] = target.get('sum', 0) + source['sum']; target['count'] = target.get('count', 0) + source['count']
+        for name in ('queries', 'db_seconds', 'render_seconds', 'slow_queries'): merged[name] += entry[name]
+    return total
+
+
+def _pid_of(name):
+    """The pid in a worker file name: `<pid>-<token>.json`, or `<pid>.json` as written by older versions."""
+    pid = name[:-len('.json')].split('-', 1)[0]
+    return int(pid) if pid.isdigit() else None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # exists, owned by someone else
+    return True
+
+
+def _observe(histogram, buckets, value):
+    counts = histogram.setdefault('buckets', [0] * len(buckets))
+    for i, bound in enumerate(buckets):
+        if value <= bound: counts[i] += 1
+    histogram['sum'] = histogram.get('sum', 0) + value
+    histogram['count'] = histogram.get('count', 0) + 1
+
+
+class MetricsRegistry:
+    ARCHIVE_NAME = 'archived.json'
+
+    def __init__(self, directory, namespace='app', flush_interval=5.0):
+        self.directory = directory
+        self.namespace = namespace
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._data = {}
+        self._flushed_at = 0.0
+        self._pid = None; self._token = None
+
+    def _own_name(self):
+        if self._pid != os.getpid():  # first use, or a forked worker that inherited the parent's registry
+            self._pid = os.getpid(); self._token = secrets.token_hex(4)
+        return f'{self._pid}-{self._token}.json'
+
+    @contextmanager
+    def _dir_lock(self, exclusive):
+        """Serializes folding (exclusive) against reading (shared) across processes."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read(self, name, default=None):
+        try:
+            with open(os.path.join(self.directory, name)) as f: return json.load(f)
+        except (OSError, ValueError):
+            return default
+
+    def _write(self, name, data):
+        path = os.path.join(self.directory, name); tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f: json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def _worker_files(self):
+        return [name for name in os.listdir(self.directory)
+                if name.endswith('.json') and _pid_of(name) is not None]
+
+    def record(self, endpoint, method, status, stats):
+        """Adds one finished request; flushes this process's snapshot if it is due."""
+        duration = time.perf_counter() - stats.started
+        with self._lock:
+            entry = self._data.setdefault(endpoint, _new_entry())
+            key = f'{method} {status}'
+            entry['requests'][key] = entry['requests'].get(key, 0) + 1
+            _observe(entry['latency'], LATENCY_BUCKETS, duration)
+            _observe(entry['queries_per_request'], QUERY_BUCKETS, stats.queries)
+            entry['queries'] += stats.queries; entry['db_seconds'] += stats.db_time
+            entry['render_seconds'] += stats.render_time; entry['slow_queries'] += stats.slow_queries
+            due = time.monotonic() - self._flushed_at >= self.flush_interval
+        if due: self.flush()
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self._data))
+
+    def flush(self):
+        """Atomically writes this process's snapshot to the shared directory (once it has served a request)."""
+        if not self._data: return
+        os.makedirs(self.directory, exist_ok=True)
+        self._write(self._own_name(), self.snapshot())
+        self._flushed_at = time.monotonic()
+
+    def retire(self):
+        """At exit: folds this process's totals into the archive and removes its file."""
+        if not self._data: return
+        with self._dir_lock(exclusive=True):
+            self._write(self._own_name(), self.snapshot())
+            self._fold([self._own_name()])
+
+    def _fold(self, names):
+        """Moves worker files into the archive; call with the exclusive lock held.
+
+        The archive records the names it has absorbed before the files are removed, so a crash in between cannot
+        count a worker twice.
+        """
+        archive = self._read(self.ARCHIVE_NAME, {'endpoints': {}, 'folded': []})
+        folded = set(archive['folded']); present = set(self._worker_files())
+        for name in names:
+            if name in folded: continue
+            snapshot = self._read(name)
+            if snapshot is not None: _merge(archive['endpoints'], snapshot)
+            folded.add(name)
+        archive['folded'] = sorted(folded & present)
+        self._write(self.ARCHIVE_NAME, archive)
+        for name in folded & present:
+            try: os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError: pass
+
+    def collect(self):
+        """Sums the archive and the snapshots of every live process, using live numbers for this one."""
+        total = _merge({}, self.snapshot())
+        if not os.path.isdir(self.directory): return total
+        own = self._own_name()
+        dead = [name for name in self._worker_files() if name != own and not _pid_alive(_pid_of(name))]
+        if dead:
+            with self._dir_lock(exclusive=True): self._fold(dead)
+        with self._dir_lock(exclusive=False):
+            archive = self._read(self.ARCHIVE_NAME, {'endpoints': {}, 'folded': []})
+            _merge(total, archive['endpoints']); folded = set(archive['folded'])
+            for name in self._worker_files():
+                if name == own or name in folded: continue
+                snapshot = self._read(name)
+                if snapshot is not None: _merge(total, snapshot)
+        return total
+
+    def render(self, gauges=()):
+        """The aggregated metrics in Prometheus text exposition format; `gauges` adds (name, help, {labels: value})."""
+        ns = self.namespace; data = self.collect(); lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f'# HELP {ns}_{name} {help_text}'); lines.append(f'# TYPE {ns}_{name} {kind}')
+
+        def histogram(name, field, buckets):
+            for endpoint, entry in sorted(data.items()):
+                hist = entry[field]
+                if not hist: continue
+                for bound, count in zip(buckets, hist['buckets']):
+                    lines.append(f'{ns}_{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                lines.append(f'{ns}_{name}_bucket{{endpoint="{endpoint}",le="+Inf"}} {hist["count"]}')
+                lines.append(f'{ns}_{name}_sum{{endpoint="{endpoint}"}} {hist["sum"]:.6f}')
+                lines.append(f'{ns}_{name}_count{{endpoint="{endpoint}"}} {hist["count"]}')
+
+        family('http_requests_total', 'counter', 'Requests by endpoint, method and status.')
+        for endpoint, entry in sorted(data.items()):
+            for key, count in sorted(entry['requests'].items()):
+                method, status = key.split(' ')
+                lines.append(f'{ns}_http_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}')
+        family('http_request_duration_seconds', 'histogram', 'Request latency by endpoint.')
+        histogram('http_request_duration_seconds', 'latency', LATENCY_BUCKETS)
+        family('db_queries_per_request', 'histogram', 'SQL statements executed per request.')
+        histogram('db_queries_per_request', 'queries_per_request', QUERY_BUCKETS)
+        for name, field, help_text in (('db_queries_total', 'queries', 'SQL statements executed.'),
+                                       ('db_seconds_total', 'db_seconds', 'Time spent executing SQL.'),
+                                       ('template_render_seconds_total', 'render_seconds', 'Time spent rendering templates.'),
+                                       ('db_slow_queries_total', 'slow_queries', 'SQL statements over the slow query threshold.')):
+            family(name, 'counter', help_text)
+            for endpoint, entry in sorted(data.items()):
+                value = entry[field]
+                lines.append(f'{ns}_{name}{{endpoint="{endpoint}"}} {value:.6f}' if isinstance(value, float) else
+                             f'{ns}_{name}{{endpoint="{endpoint}"}} {value}')
+        for name, help_text, samples in gauges:
+            family(name, 'gauge', help_text)
+            for labels, value in sorted(samples.items()):
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f'{ns}_{name}{{{label_text}}} {value}' if label_text else f'{ns}_{name} {value}')
+        return '\n'.join(lines) + '\n'
@@ -3,11 +3,21 @@
 
 -- Drop tables in reverse order of dependency to prevent foreign key errors.
 
+DROP TABLE IF EXISTS users_search;
+DROP TABLE IF EXISTS rate_limit_buckets;
+DROP TABLE IF EXISTS jobs;
+DROP TABLE IF EXISTS media_objects;
+DROP TABLE IF EXISTS catalog_version;
+DROP TABLE IF EXISTS user_course_progress;
+DROP TABLE IF EXISTS user_session_progress;
 DROP TABLE IF EXISTS password_reset_tokens;
+DROP TABLE IF EXISTS quiz_attempt_history;
 DROP TABLE IF EXISTS student_quiz_attempts;
+DROP TABLE IF EXISTS video_positions;
 DROP TABLE IF EXISTS video_completions;
 DROP TABLE IF EXISTS student_course_access;
 DROP TABLE IF EXISTS quizzes;
+DROP TABLE IF EXISTS session_videos;
 DROP TABLE IF EXISTS sessions;
 DROP TABLE IF EXISTS courses;
 DROP TABLE IF EXISTS users;
@@ -21,6 +31,7 @@ CREATE TABLE users (
     password VARCHAR(200) NOT NULL, 
     account_code VARCHAR(50) NOT NULL, 
     is_admin BOOLEAN NOT NULL, 
+    auth_version INTEGER DEFAULT 1 NOT NULL, 
     PRIMARY KEY (id), 
     UNIQUE (email), 
     UNIQUE (account_code)
@@ -45,13 +56,23 @@ CREATE TABLE sessions (
     title VARCHAR(150) NOT NULL, 
     thumbnail_url VARCHAR(200), 
     is_free BOOLEAN NOT NULL, 
-    video1_url VARCHAR(300), 
-    video2_url VARCHAR(300), 
-    video3_url VARCHAR(300), 
-    video4_url VARCHAR(300), 
+    video_count INTEGER DEFAULT 0 NOT NULL, 
     PRIMARY KEY (id), 
     FOREIGN KEY(course_id) REFERENCES courses (id) ON DELETE CASCADE
 );
+CREATE INDEX ix_sessions_course_id ON sessions (course_id);
+
+-- Ordered videos of a session; position is the 1-based video number
+CREATE TABLE session_videos (
+    id INTEGER NOT NULL, 
+    session_id INTEGER NOT NULL, 
+    position INTEGER NOT NULL, 
+    url VARCHAR(300) NOT NULL, 
+    hls_status VARCHAR(20), 
+    PRIMARY KEY (id), 
+    CONSTRAINT uq_session_videos_session_position UNIQUE (session_id, position), 
+    FOREIGN KEY(session_id) REFERENCES sessions (id) ON DELETE CASCADE
+);
 
 -- Table for quiz questions
 CREATE TABLE quizzes (
@@ -66,6 +87,7 @@ CREATE TABLE quizzes (
     PRIMARY KEY (id), 
     FOREIGN KEY(session_id) REFERENCES sessions (id) ON DELETE CASCADE
 );
+CREATE INDEX ix_quizzes_session_id ON quizzes (session_id);
 
 -- Table to link students to the courses they have access to
 CREATE TABLE student_course_access (
@@ -75,8 +97,9 @@ CREATE TABLE student_course_access (
     PRIMARY KEY (id), 
     FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE CASCADE, 
     FOREIGN KEY(course_id) REFERENCES courses (id) ON DELETE CASCADE,
-    UNIQUE (user_id, course_id)
+    CONSTRAINT uq_student_course_access_user_course UNIQUE (user_id, course_id)
 );
+CREATE INDEX ix_student_course_access_course_id ON student_course_access (course_id);
 
 -- Table to track completion of individual videos
 CREATE TABLE video_completions (
@@ -88,8 +111,23 @@ CREATE TABLE video_completions (
     PRIMARY KEY (id), 
     FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE CASCADE, 
     FOREIGN KEY(session_id) REFERENCES sessions (id) ON DELETE CASCADE,
-    UNIQUE (user_id, session_id, video_index)
+    CONSTRAINT uq_video_completions_user_session_video UNIQUE (user_id, session_id, video_index)
+);
+CREATE INDEX ix_video_completions_session_id ON video_completions (session_id);
+
+-- Last reported playback position per user and video, for resuming
+CREATE TABLE video_positions (
+    user_id INTEGER NOT NULL, 
+    session_id INTEGER NOT NULL, 
+    video_index INTEGER NOT NULL, 
+    position FLOAT NOT NULL, 
+    duration FLOAT, 
+    updated_at DATETIME NOT NULL, 
+    PRIMARY KEY (user_id, session_id, video_index), 
+    FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE CASCADE, 
+    FOREIGN KEY(session_id) REFERENCES sessions (id) ON DELETE CASCADE
 );
+CREATE INDEX ix_video_positions_session_id ON video_positions (session_id);
 
 -- Table to store student quiz results
 CREATE TABLE student_quiz_attempts (
@@ -99,10 +137,30 @@ CREATE TABLE student_quiz_attempts (
     score INTEGER NOT NULL, 
     total_questions INTEGER NOT NULL, 
     attempted_on DATETIME NOT NULL, 
+    best_score INTEGER, 
+    attempt_count INTEGER DEFAULT 1 NOT NULL, 
     PRIMARY KEY (id), 
+    CONSTRAINT uq_student_quiz_attempts_user_session UNIQUE (user_id, session_id), 
     FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE CASCADE, 
     FOREIGN KEY(session_id) REFERENCES sessions (id) ON DELETE CASCADE
 );
+CREATE INDEX ix_student_quiz_attempts_session_id ON student_quiz_attempts (session_id);
+
+-- Append-only history of every graded quiz submission
+CREATE TABLE quiz_attempt_history (
+    id INTEGER NOT NULL, 
+    user_id INTEGER NOT NULL, 
+    session_id INTEGER NOT NULL, 
+    score INTEGER NOT NULL, 
+    total_questions INTEGER NOT NULL, 
+    answers TEXT NOT NULL, 
+    attempted_on DATETIME NOT NULL, 
+    PRIMARY KEY (id), 
+    FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE CASCADE, 
+    FOREIGN KEY(session_id) REFERENCES sessions (id) ON DELETE CASCADE
+);
+CREATE INDEX ix_quiz_attempt_history_user_session ON quiz_attempt_history (user_id, session_id);
+CREATE INDEX ix_quiz_attempt_history_session_id ON quiz_attempt_history (session_id);
 
 -- Table for temporary password reset tokens
 CREATE TABLE password_reset_tokens (
@@ -114,3 +172,86 @@ CREATE TABLE password_reset_tokens (
     FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE CASCADE, 
     UNIQUE (token)
 );
+CREATE INDEX ix_password_reset_tokens_user_id ON password_reset_tokens (user_id);
+CREATE INDEX ix_password_reset_tokens_expires_at ON password_reset_tokens (expires_at);
+
+-- Login/register throttling buckets shared by all workers (updated_at is epoch seconds)
+CREATE TABLE rate_limit_buckets (
+    key VARCHAR(200) NOT NULL, 
+    tokens FLOAT NOT NULL, 
+    capacity FLOAT NOT NULL, 
+    refill_rate FLOAT NOT NULL, 
+    updated_at FLOAT NOT NULL, 
+    PRIMARY KEY (key)
+);
+CREATE INDEX ix_rate_limit_buckets_updated_at ON rate_limit_buckets (updated_at);
+
+-- Per-user rollups of video_completions, maintained by the application
+CREATE TABLE user_session_progress (
+    user_id INTEGER NOT NULL, 
+    session_id INTEGER NOT NULL, 
+    course_id INTEGER NOT NULL, 
+    completed_videos INTEGER NOT NULL, 
+    PRIMARY KEY (user_id, session_id), 
+    FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE CASCADE, 
+    FOREIGN KEY(session_id) REFERENCES sessions (id) ON DELETE CASCADE, 
+    FOREIGN KEY(course_id) REFERENCES courses (id) ON DELETE CASCADE
+);
+CREATE INDEX ix_user_session_progress_user_course ON user_session_progress (user_id, course_id);
+CREATE INDEX ix_user_session_progress_session_id ON user_session_progress (session_id);
+
+CREATE TABLE user_course_progress (
+    user_id INTEGER NOT NULL, 
+    course_id INTEGER NOT NULL, 
+    completed_videos INTEGER NOT NULL, 
+    PRIMARY KEY (user_id, course_id), 
+    FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE CASCADE, 
+    FOREIGN KEY(course_id) REFERENCES courses (id) ON DELETE CASCADE
+);
+
+-- Single row (id = 1) bumped whenever an admin changes courses, sessions or quizzes
+CREATE TABLE catalog_version (
+    id INTEGER NOT NULL, 
+    version INTEGER NOT NULL, 
+    updated_at DATETIME NOT NULL, 
+    PRIMARY KEY (id)
+);
+INSERT INTO catalog_version (id, version, updated_at) VALUES (1, 1, CURRENT_TIMESTAMP);
+
+-- Files in the content-addressed upload store (static/uploads/<sha[:2]>/<sha>.<ext>)
+CREATE TABLE media_objects (
+    id INTEGER NOT NULL, 
+    url VARCHAR(300) NOT NULL, 
+    sha256 VARCHAR(64) NOT NULL, 
+    size BIGINT NOT NULL, 
+    ref_count INTEGER NOT NULL, 
+    created_at DATETIME NOT NULL, 
+    PRIMARY KEY (id), 
+    UNIQUE (url)
+);
+
+-- Durable background jobs, run by `flask worker`
+CREATE TABLE jobs (
+    id INTEGER NOT NULL, 
+    kind VARCHAR(50) NOT NULL, 
+    payload TEXT NOT NULL, 
+    status VARCHAR(20) NOT NULL, 
+    attempts INTEGER NOT NULL, 
+    max_attempts INTEGER NOT NULL, 
+    run_at DATETIME NOT NULL, 
+    idempotency_key VARCHAR(200), 
+    last_error TEXT, 
+    locked_by VARCHAR(100), 
+    locked_at DATETIME, 
+    created_at DATETIME NOT NULL, 
+    finished_at DATETIME, 
+    PRIMARY KEY (id), 
+    UNIQUE (idempotency_key)
+);
+CREATE INDEX ix_jobs_status_run_at ON jobs (status, run_at);
+
+-- Trigram full-text index behind the admin student search, kept in sync with users by triggers
+CREATE VIRTUAL TABLE users_search USING fts5(name, email, account_code, content='users', content_rowid='id', tokenize='trigram');
+CREATE TRIGGER users_search_ai AFTER INSERT ON users BEGIN INSERT INTO users_search(rowid, name, email, account_code) VALUES (new.id, new.name, new.email, new.account_code); END;
+CREATE TRIGGER users_search_ad AFTER DELETE ON users BEGIN INSERT INTO users_search(users_search, rowid, name, email, account_code) VALUES ('delete', old.id, old.name, old.email, old.account_code); END;
+CREATE TRIGGER users_search_au AFTER UPDATE OF name, email, account_code ON users BEGIN INSERT INTO users_search(users_search, rowid, name, email, account_code) VALUES ('delete', old.id, old.name, old.email, old.account_code); INSERT INTO users_search(rowid, name, email, account_code) VALUES (new.id, new.name, new.email, new.account_code); END;
@@ -0,0 +1,23 @@
+import io
+import os
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from app import read_enrollment_csv
+
+
+def rows(text):
+    return list(read_enrollment_csv(io.StringIO(text)))
+
+
+def test_one_column_header_is_skipped():
+    assert rows('email\nstu@x\nnobody@x\n') == [(2, 'stu@x', ''), (3, 'nobody@x', '')]
+    assert rows('Account_Code\nAI-1\n') == [(2, 'AI-1', '')]
+
+
+def test_two_column_header_is_skipped():
+    assert rows('student,course\nstu@x,3\n') == [(2, 'stu@x', '3')]
+
+
+def test_first_row_without_header_is_kept():
+    assert rows('stu@x\n\nAI-1,4\n') == [(1, 'stu@x', ''), (3, 'AI-1', '4')]
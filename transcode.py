@@ -0,0 +1,129 @@
+"""HLS renditions of uploaded videos, made with a local ffmpeg.
+
+A video's ladder lives next to the original as `<name>.hls/`: `master.m3u8`
+plus one `<rendition>/index.m3u8` and its `.ts` segments per rung, so it can
+always be found (and cleaned up) from the original's path alone. Rungs taller
+than the source are skipped; videos are never upscaled.
+ffmpeg and ffprobe are optional: without them nothing is transcoded and pages
+keep serving the original files.
+"""
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from collections import namedtuple
+
+FFMPEG = os.environ.get('FFMPEG') or shutil.which('ffmpeg')
+FFPROBE = os.environ.get('FFPROBE') or shutil.which('ffprobe')
+
+Rendition = namedtuple('Rendition', 'name height video_kbps audio_kbps')
+RENDITIONS = (
+    Rendition('1080p', 1080, 5000, 192),
+    Rendition('720p', 720, 2800, 128),
+    Rendition('480p', 480, 1400, 128),
+    Rendition('360p', 360, 800, 96),
+)
+MASTER_NAME = 'master.m3u8'
+HLS_MIMETYPES = {'m3u8': 'application/vnd.apple.mpegurl', 'ts': 'video/mp2t'}
+_HLS_OUTPUT_RE = re.compile(r'\.hls/.+$')
+
+
+class TranscodeError(RuntimeError):
+    """ffmpeg could not transcode a file; retrying the same file will not help."""
+
+
+def ffmpeg_available():
+    return FFMPEG is not None and FFPROBE is not None
+
+
+def hls_dir(path):
+    return f'{path.rsplit(".", 1)[0]}.hls'
+
+
+def master_path(path):
+    return os.path.join(hls_dir(path), MASTER_NAME)
+
+
+def is_hls_output(path):
+    return bool(_HLS_OUTPUT_RE.search(path))
+
+
+def hls_stem(path):
+    """The original's path minus its extension, for a file inside an HLS directory."""
+    return _HLS_OUTPUT_RE.sub('', path)
+
+
+def hls_ready(src_path):
+    master = master_path(src_path)
+    return os.path.isfile(master) and os.path.getmtime(master) >= os.path.getmtime(src_path)
+
+
+def probe(src_path):
+    """(height of the first video stream, whether there is an audio stream)."""
+    result = subprocess.run([FFPROBE, '-v', 'error', '-show_entries', 'stream=codec_type,height', '-of', 'csv=p=0', src_path],
+                            capture_output=True, text=True)
+    if result.returncode != 0: raise TranscodeError(f'ffprobe failed: {result.stderr.strip()[-500:]}')
+    streams = [line.split(',') for line in result.stdout.split()]
+    heights = [int(fields[1]) for fields in streams if fields[0] == 'video' and len(fields) > 1 and fields[1].isdigit()]
+    if not heights: raise TranscodeError('no video stream')
+    return heights[0], any(fields[0] == 'audio' for fields in streams)
+
+
+def ladder(height, renditions=RENDITIONS):
+    """The rungs to make for a source of `height` pixels; a source below every rung gets one at its own height."""
+    rungs = [r for r in renditions if r.height <= height]
+    return rungs or [min(renditions, key=lambda r: r.height)._replace(name=f'{height}p', height=height - height % 2)]
+
+
+def ffmpeg_command(src_path, out_dir, rungs, has_audio, segment_seconds=6):
+    """One ffmpeg run that decodes once and encodes every rung, writing the playlists and segments to `out_dir`."""
+    split = f'[0:v]split={len(rungs)}' + ''.join(f'[v{i}]' for i in range(len(rungs)))
+    scales = ';'.join(f'[v{i}]scale=-2:{r.height}[v{i}out]' for i, r in enumerate(rungs))
+    cmd = [FFMPEG, '-hide_banner', '-loglevel', 'error', '-y', '-i', src_path, '-filter_complex', f'{split};{scales}']
+    for i, r in enumerate(rungs):
+        cmd += ['-map', f'[v{i}out]', f'-c:v:{i}', 'libx264', f'-b:v:{i}', f'{r.video_kbps}k',
+                f'-maxrate:v:{i}', f'{r.video_kbps * 107 // 100}k', f'-bufsize:v:{i}', f'{r.video_kbps * 3 // 2}k']
+        if has_audio: cmd += ['-map', '0:a:0', f'-c:a:{i}', 'aac', f'-b:a:{i}', f'{r.audio_kbps}k']
+    # Key frames on segment boundaries, whatever the frame rate, so every rung can be switched at every segment.
+    cmd += ['-preset', 'veryfast', '-profile:v', 'main', '-pix_fmt', 'yuv420p', '-sc_threshold', '0',
+            '-force_key_frames', f'expr:gte(t,n_forced*{segment_seconds})']
+    if has_audio: cmd += ['-ac', '2']
+    streams = ' '.join(f'v:{i},a:{i},name:{r.name}' if has_audio else f'v:{i},name:{r.name}' for i, r in enumerate(rungs))
+    cmd += ['-f', 'hls', '-hls_time', str(segment_seconds), '-hls_playlist_type', 'vod', '-hls_flags', 'independent_segments',
+            '-hls_segment_filename', os.path.join(out_dir, '%v', 'seg_%05d.ts'), '-master_pl_name', MASTER_NAME,
+            '-var_stream_map', streams, os.path.join(out_dir, '%v', 'index.m3u8')]
+    return cmd
+
+
+def transcode_hls(src_path, renditions=RENDITIONS, segment_seconds=6, timeout=None):
+    """Writes the HLS ladder of one video unless an up-to-date one exists; returns the master playlist's path.
+
+    The ladder is built in a temporary directory and renamed into place, so a half-written one is never served.
+    """
+    if not ffmpeg_available(): raise RuntimeError('ffmpeg and ffprobe are not installed')
+    if hls_ready(src_path): return master_path(src_path)
+    height, has_audio = probe(src_path)
+    final_dir = hls_dir(src_path)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(src_path), prefix=os.path.basename(final_dir) + '.tmp-')
+    try:
+        try:
+            result = subprocess.run(ffmpeg_command(src_path, tmp_dir, ladder(height, renditions), has_audio, segment_seconds),
+                                    capture_output=True, text=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            raise TranscodeError(f'ffmpeg did not finish within {timeout} seconds') from None
+        if result.returncode != 0: raise TranscodeError(f'ffmpeg failed: {result.stderr.strip()[-500:]}')
+        if os.path.isdir(final_dir):
+            if hls_ready(src_path): return master_path(src_path)  # another worker finished first
+            shutil.rmtree(final_dir)  # made from an older file at the same path
+        try:
+            os.rename(tmp_dir, final_dir)
+        except OSError:
+            if not hls_ready(src_path): raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return master_path(src_path)
+
+
+def remove_hls(src_path):
+    shutil.rmtree(hls_dir(src_path), ignore_errors=True)
@@ -0,0 +1,104 @@
+"""An in-process write-behind buffer that coalesces frequent updates per key.
+
+Callers `add` values as often as they like; values for the same key are merged in memory and a background
+thread hands the pending batch to `flush_fn` every `interval` seconds (sooner once `max_pending` keys are
+waiting). A batch that fails to flush is merged back in and retried on the next round, so nothing is lost
+while the database is briefly unavailable. After `max_failures` failed rounds the batch is written one key at a
+time, and keys that still fail while others succeed are dropped (reported to `on_drop`), so one bad key cannot
+hold up everyone else's. At `max_keys` pending keys, values for new keys are refused until the next flush.
+Call `close` at shutdown to write out whatever is still pending.
+"""
+import threading
+
+
+class WriteBehindBuffer:
+    def __init__(self, flush_fn, merge_fn, interval=10.0, max_pending=10000, max_keys=None, max_failures=3,
+                 on_error=None, on_drop=None):
+        self._flush_fn = flush_fn
+        self._merge = merge_fn
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_keys = max_keys or 10 * max_pending
+        self.max_failures = max_failures
+        self._on_error = on_error
+        self._on_drop = on_drop
+        self._failures = 0
+        self.dropped = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = None
+
+    def add(self, key, value):
+        """Buffers `value` for `key`; returns False if it was refused because the buffer is full."""
+        with self._lock:
+            old = self._pending.get(key)
+            if old is None and len(self._pending) >= self.max_keys:
+                self.dropped += 1; self._wake.set()
+                return False
+            self._pending[key] = value if old is None else self._merge(old, value)
+            full = len(self._pending) >= self.max_pending
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True); self._thread.start()
+        if full: self._wake.set()
+        return True
+
+    def peek(self, key):
+        """The value still waiting to be flushed for `key`, if any."""
+        with self._lock:
+            return self._pending.get(key)
+
+    def flush(self):
+        """Writes everything pending now; returns the number of keys written."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch: return 0
+            try:
+                self._flush_fn(batch)
+            except Exception as e:
+                self._failures += 1
+                if self._on_error is not None: self._on_error(e)
+                if self._failures < self.max_failures or len(batch) == 1:
+                    self._requeue(batch); return 0
+                return self._flush_each(batch)
+            self._failures = 0
+            return len(batch)
+
+    def _flush_each(self, batch):
+        """Writes a repeatedly failing batch key by key. Failing keys are dropped if any other key got through;
+        if none did, the store itself is down and the whole batch is kept for the next round."""
+        failed = {}
+        for key, value in batch.items():
+            try:
+                self._flush_fn({key: value})
+            except Exception as e:
+                failed[key] = (value, e)
+        if len(failed) == len(batch):
+            self._requeue(batch); return 0
+        self._failures = 0
+        for key, (value, e) in failed.items():
+            self.dropped += 1
+            if self._on_drop is not None: self._on_drop(key, e)
+        return len(batch) - len(failed)
+
+    def _requeue(self, batch):
+        with self._lock:
+            for key, value in batch.items():
+                newer = self._pending.get(key)
+                self._pending[key] = value if newer is None else self._merge(value, newer)
+
+    def close(self):
+        self._closed = True; self._wake.set()
+        if self._thread is not None: self._thread.join(timeout=self.interval)
+        self.flush()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.interval); self._wake.clear()
+            if not self._closed: self.flush()